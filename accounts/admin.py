@@ -1,14 +1,36 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Staff, FAQ, Accessory
+from django.db.models import Count, Prefetch
+
+from shop.models import Participation
+from shop.pagination import EstimatedCountPaginator
+from .models import User, Staff, FAQ, Accessory, SMSMessage
 
 
 class UserAdmin(admin.ModelAdmin):
     ordering = ['date_joined']
     list_display = ['phone_number', 'first_name', 'last_name', 'email', 'is_staff', 'is_active', 'participation_presentations']
     list_filter = ['is_staff', 'is_active', 'date_joined']
-    search_fields = ['phone_number', 'first_name', 'last_name', 'email']
+    # Prefix searches, so they can use the indexes on these columns.
+    search_fields = ['^phone_number', '^first_name', '^last_name', '^email']
     filter_horizontal = ('groups', 'user_permissions')
+    autocomplete_fields = ['accessories']
+    paginator = EstimatedCountPaginator
+    # Filtered changelists would count the whole table again for "(N total)".
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('participations', queryset=Participation.objects.select_related('presentation').only(
+                'user_id', 'presentation__en_title'
+            ))
+        )
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        if db_field.name == 'user_permissions':
+            # Permissions are shown with their content type.
+            kwargs['queryset'] = db_field.remote_field.model.objects.select_related('content_type')
+        return super().formfield_for_manytomany(db_field, request=request, **kwargs)
 
     def participation_presentations(self, obj):
         thing = [p.presentation.en_title for p in obj.participations.all()]
@@ -22,10 +44,22 @@ admin.site.register(FAQ)
 @admin.register(Accessory)
 class AccessoryAdmin(admin.ModelAdmin):
     list_display = ['name', 'price', 'get_bought_count']
+    search_fields = ['name']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(bought_count=Count('accessories'))
+
+    @admin.display(ordering='bought_count')
     def get_bought_count(self, obj):
-        return obj.accessories.count()
+        return obj.bought_count
 
 @admin.register(Staff)
 class StaffAdmin(admin.ModelAdmin):
-    pass
\ No newline at end of file
+    pass
+
+@admin.register(SMSMessage)
+class SMSMessageAdmin(admin.ModelAdmin):
+    list_display = ['mobile', 'state', 'attempts', 'created_date', 'sent_date']
+    list_filter = ['state']
+    search_fields = ['mobile']
+    readonly_fields = ['created_date', 'sent_date']
@@ -0,0 +1,67 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from accounts.sms import drain_outbox, get_client, outbox_stats
+
+
+class Command(BaseCommand):
+    help = ('Send the queued text messages, with identical texts batched into one request, '
+            'and retry failed requests with backoff.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain what is due and exit, instead of polling.')
+        parser.add_argument('--interval', type=float, default=1, help='Seconds to wait when nothing is due.')
+        parser.add_argument('--limit', type=int, default=1000,
+                            help='Messages claimed per round, at most what can be sent within SMS_SEND_TIMEOUT.')
+        parser.add_argument('--stats-every', type=int, default=60,
+                            help='Seconds between queue depth and latency reports.')
+
+    def handle(self, *args, **options):
+        # One client for the life of the worker.
+        client = get_client()
+        sent, failed, latencies, busy = 0, 0, [], 0
+        reported = time.monotonic()
+        while True:
+            started = time.monotonic()
+            try:
+                round_sent, round_failed, round_latencies = drain_outbox(client, limit=options['limit'])
+            except (OperationalError, InterfaceError) as e:
+                if options['once']:
+                    raise
+                # Lost the database, e.g. on a restart. Claimed messages are claimed again once the send
+                # timeout passes, so keep polling with a fresh connection.
+                self.stderr.write(f'Database error, retrying in {options["interval"]} s: {e}')
+                close_old_connections()
+                time.sleep(options['interval'])
+                continue
+            sent, failed = sent + round_sent, failed + round_failed
+            latencies += round_latencies
+            if round_sent + round_failed:
+                busy += time.monotonic() - started
+
+            if options['once'] or time.monotonic() - reported >= options['stats_every']:
+                self.report(sent, failed, latencies, busy)
+                sent, failed, latencies, busy = 0, 0, [], 0
+                reported = time.monotonic()
+            if options['once']:
+                return
+            # Drops connections the database has closed or that outlived CONN_MAX_AGE, busy or not.
+            close_old_connections()
+            if not round_sent + round_failed:
+                time.sleep(options['interval'])
+
+    def report(self, sent, failed, latencies, busy):
+        stats = outbox_stats()
+        latency = ''
+        if latencies:
+            latencies = sorted(latencies)
+            # The rate while there was something to send, what SMS_SEND_RATE should be set to.
+            latency = (f', {(sent + failed) / busy if busy else 0:.1f} message(s)/s while busy, send latency median '
+                       f'{statistics.median(latencies) * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms')
+        self.stdout.write(
+            f'Sent {sent} and failed {failed} message(s){latency}. Queue: {stats["pending"]} pending, '
+            f'{stats["due"]} due, oldest waiting {stats["oldest_wait"]:.0f} s.'
+        )
@@ -93,6 +93,13 @@ class User(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'phone_number'
     REQUIRED_FIELDS = ['first_name', 'last_name', 'email']
 
+    class Meta:
+        indexes = [
+            # For the admin's prefix searches, phone_number and email are indexed by their unique constraints.
+            models.Index(fields=['first_name'], name='user_first_name_idx'),
+            models.Index(fields=['last_name'], name='user_last_name_idx'),
+        ]
+
     def get_full_name(self):
         return self.first_name + ' ' + self.last_name
 
@@ -143,4 +150,36 @@ class FAQ(models.Model):
     answer = HTMLField()
 
     def __str__(self):
-        return self.question
\ No newline at end of file
+        return self.question
+
+SMS_STATES = [
+    ("PENDING", "Pending"),
+    ("SENT", "Sent"),
+    ("FAILED", "Failed"),
+]
+
+
+class SMSMessage(models.Model):
+    """
+    Outbox record of an SMS to one phone number. Messages are queued with `accounts.sms.enqueue_sms` and
+    sent by `manage.py drain_sms_outbox`, which sends identical texts to many numbers in one request.
+    """
+    mobile = models.CharField(max_length=32)
+    message_text = models.TextField()
+    state = models.CharField(choices=SMS_STATES, default="PENDING", max_length=10)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # When a pending message is due, pushed back while a worker sends it and after a failed attempt.
+    next_attempt = models.DateTimeField(default=timezone.now)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+    sent_date = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'SMS message'
+        indexes = [
+            models.Index(fields=['state', 'next_attempt'], name='sms_state_next_attempt_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.mobile} - {self.state}'
@@ -1,33 +1,185 @@
-from kavenegar import *
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from itertools import groupby
+
+import requests
 from django.conf import settings
-from concurrent.futures import ThreadPoolExecutor
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+from kavenegar import APIException as KavenegarAPIException, HTTPException, KavenegarAPI
+from rest_framework import status
+from rest_framework.exceptions import APIException
 
+from .models import SMSMessage
 
-SMS_EXECUTOR = ThreadPoolExecutor(max_workers=10)
 API_KEY = settings.SMS_KEY
 LINE_NUMBER = settings.SMS_LINE_NUMBER
 OTP_VALIDITY_PERIOD = 120 # 2 minutes
 OTP_RESEND_DELAY = 60  # 1 minute
 
-def send_sms(mobiles, message_text):
-    try:
-        api = KavenegarAPI(API_KEY)
-
-        receptor = ''
-        for mobile in mobiles: receptor += mobile + ', '
-        receptor = receptor[:-2]
-
-        params = {
-            'sender': str(LINE_NUMBER),  # optional
-            'receptor': receptor,
-            'message': message_text,
-        }
-        response = api.sms_send(params)
-        print(response)
-    except APIException as e:
-        print(e)
-    except HTTPException as e:
-        print(e)
-
-    except Exception as e:
-        print(f"Server failed to send SMS: {e}")
+
+class SMSOutboxFull(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many text messages are waiting to be sent, please try again in a minute.'
+    default_code = 'sms_outbox_full'
+
+
+def enqueue_sms(mobiles, message_text, check_backlog=True):
+    """
+    Queue `message_text` for each of `mobiles`, to be sent by `manage.py drain_sms_outbox`. Queued in the
+    current transaction, so it is only sent if the transaction commits. With `check_backlog`, refuses with
+    SMSOutboxFull while SMS_OUTBOX_MAX_PENDING messages are waiting, more than the worker sends in a quarter
+    of an OTP's validity, so a flood of requests is turned away instead of queueing texts that would arrive
+    too late to be useful.
+    """
+    if check_backlog and pending_count() >= settings.SMS_OUTBOX_MAX_PENDING:
+        raise SMSOutboxFull()
+    return SMSMessage.objects.bulk_create(
+        [SMSMessage(mobile=mobile, message_text=message_text) for mobile in dict.fromkeys(mobiles)],
+        batch_size=1000,
+    )
+
+
+def pending_count():
+    return SMSMessage.objects.filter(state="PENDING").count()
+
+
+def outbox_stats():
+    """The queue depth, how much of it is due, and how long the oldest message has been waiting, in seconds."""
+    now = timezone.now()
+    pending = SMSMessage.objects.filter(state="PENDING")
+    oldest = pending.aggregate(oldest=Min('created_date'))['oldest']
+    return {
+        'pending': pending.count(),
+        'due': pending.filter(next_attempt__lte=now).count(),
+        'oldest_wait': (now - oldest).total_seconds() if oldest else 0,
+    }
+
+
+class TimeoutKavenegarAPI(KavenegarAPI):
+    """KavenegarAPI with a timeout on its requests, which it doesn't set, so a send can't outlive its lease."""
+
+    def __init__(self, apikey, timeout):
+        super().__init__(apikey)
+        self.timeout = timeout
+
+    def _request(self, action, method, params={}):
+        url = f'https://{self.host}/{self.version}/{self.apikey}/{action}/{method}.json'
+        try:
+            content = requests.post(url, headers=self.headers, data=params, timeout=self.timeout).content
+            response = json.loads(content.decode('utf-8'))
+        except (requests.RequestException, ValueError) as e:
+            raise HTTPException(e)
+        if response['return']['status'] != 200:
+            raise KavenegarAPIException(f'APIException[{response["return"]["status"]}] {response["return"]["message"]}')
+        return response['entries']
+
+
+def get_client():
+    return TimeoutKavenegarAPI(API_KEY, timeout=settings.SMS_REQUEST_TIMEOUT)
+
+
+def send_sms(client, mobiles, message_text):
+    """Send one text to many numbers in one request. Raises the client's exceptions."""
+    return client.sms_send({
+        'sender': str(LINE_NUMBER),
+        'receptor': ', '.join(mobiles),
+        'message': message_text,
+    })
+
+
+def retry_delay(attempts):
+    return min(settings.SMS_RETRY_BACKOFF * 2 ** (attempts - 1), 60 * 60)
+
+
+def claim_size():
+    """Messages one claim can hold: what the pool sends within the lease even if each is a request of its own."""
+    return settings.SMS_SEND_CONCURRENCY * max(settings.SMS_SEND_TIMEOUT // settings.SMS_REQUEST_TIMEOUT - 1, 1)
+
+
+def claim_due(limit):
+    """
+    Claim up to `limit` due messages, by pushing their next attempt past the send timeout. A worker that
+    dies while sending leaves them to be claimed again once that passes.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(
+            SMSMessage.objects.select_for_update(skip_locked=True).filter(
+                state="PENDING", next_attempt__lte=now
+            ).order_by('next_attempt', 'id')[:limit]
+        )
+        SMSMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            next_attempt=now + timedelta(seconds=settings.SMS_SEND_TIMEOUT)
+        )
+    return messages
+
+
+def drain_outbox(client=None, limit=1000):
+    """
+    Send up to `limit` due messages, coalescing the ones with the same text into requests of up to
+    SMS_BATCH_SIZE numbers, SMS_SEND_CONCURRENCY requests at a time, and reschedule failed requests with
+    exponential backoff. Returns the number of sent and failed messages, and the latency of each request in
+    seconds.
+
+    At most claim_size() messages are claimed, and no request is started that could still be running when the
+    claim's lease runs out, so another worker never claims a message that is being sent. The messages left
+    unsent are handed back right away.
+    """
+    client = client or get_client()
+    deadline = time.monotonic() + settings.SMS_SEND_TIMEOUT - settings.SMS_REQUEST_TIMEOUT
+    messages = sorted(claim_due(min(limit, claim_size())), key=lambda message: message.message_text)
+    batches = []
+    for message_text, group in groupby(messages, key=lambda message: message.message_text):
+        group = list(group)
+        for start in range(0, len(group), settings.SMS_BATCH_SIZE):
+            batches.append((message_text, group[start:start + settings.SMS_BATCH_SIZE]))
+
+    def send(message_text, batch):
+        if time.monotonic() > deadline:
+            return None, None
+        started = time.monotonic()
+        try:
+            send_sms(client, [message.mobile for message in batch], message_text)
+        except Exception as e:
+            return e, time.monotonic() - started
+        return None, time.monotonic() - started
+
+    sent, failed, latencies, unsent = 0, 0, [], []
+    # The pool only makes the requests, the outcomes are recorded on this thread's database connection.
+    with ThreadPoolExecutor(max_workers=settings.SMS_SEND_CONCURRENCY) as pool:
+        futures = {pool.submit(send, message_text, batch): batch for message_text, batch in batches}
+        for future in as_completed(futures):
+            batch, (error, latency) = futures[future], future.result()
+            if latency is None:
+                unsent += batch
+                continue
+            latencies.append(latency)
+            if error:
+                failed += len(batch)
+                reschedule(batch, str(error))
+            else:
+                sent += len(batch)
+                SMSMessage.objects.filter(id__in=[message.id for message in batch]).update(
+                    state="SENT", sent_date=timezone.now(), last_error=''
+                )
+    if unsent:
+        SMSMessage.objects.filter(id__in=[message.id for message in unsent]).update(next_attempt=timezone.now())
+    return sent, failed, latencies
+
+
+def reschedule(messages, error):
+    by_attempts = {}
+    for message in messages:
+        by_attempts.setdefault(message.attempts + 1, []).append(message.id)
+    for attempts, ids in by_attempts.items():
+        if attempts >= settings.SMS_MAX_ATTEMPTS:
+            SMSMessage.objects.filter(id__in=ids).update(state="FAILED", attempts=attempts, last_error=error)
+        else:
+            SMSMessage.objects.filter(id__in=ids).update(
+                attempts=attempts, last_error=error,
+                next_attempt=timezone.now() + timedelta(seconds=retry_delay(attempts)),
+            )
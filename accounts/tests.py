@@ -1,5 +1,20 @@
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import kavenegar
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import override_settings
+from django.utils import timezone
 from rest_framework.test import APITestCase, APIClient
 
+from shop.throttling import check_atomic_caches
+from .models import User, SMSMessage
+from .sms import enqueue_sms, drain_outbox, get_client
+
 
 class UserTestCase(APITestCase):
     def setUp(self):
@@ -21,3 +36,176 @@ class UserTestCase(APITestCase):
         user_credentials = {'phone_number': self.user_data['phone_number'], 'password': self.user_data['password']}
         response = self.client.post(self.base_url + 'token/', data=user_credentials, format='json')
         print(response.data)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'throttle': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   AUTH_THROTTLE_RATES={'verify_ip': '4/min', 'verify_phone': '2/min', 'token_phone': '2/min'})
+class ThrottlingTestCase(APITestCase):
+    def setUp(self):
+        caches['throttle'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(phone_number='09337905450', password='te123456', first_name='test',
+                                             last_name='test', email='test@gmail.com', is_active=False)
+
+    def request_otp(self, phone_number):
+        return self.client.post('/api/users/verify/', data={'phone_number': phone_number}, format='json')
+
+    def test_otp_is_throttled_per_phone_number_and_ip(self):
+        now = time.time() // 60 * 60
+        with mock.patch('accounts.throttling.time.time', return_value=now):
+            User.objects.filter(pk=self.user.pk).update(last_otp_sent=None)
+            self.assertEqual(self.request_otp(self.user.phone_number).status_code, 200)
+            self.assertEqual(self.request_otp(self.user.phone_number).status_code, 429)  # OTP_RESEND_DELAY
+
+            with self.assertNumQueries(0):
+                response = self.request_otp(self.user.phone_number)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '60')
+            self.assertEqual(self.request_otp('09120000000').status_code, 400)
+            self.assertEqual(self.request_otp('09120000001').status_code, 429)  # The IP address is used up.
+
+        # Halfway through the next minute, half of the previous minute still counts.
+        with mock.patch('accounts.throttling.time.time', return_value=now + 90):
+            self.assertEqual([self.request_otp('09120000001').status_code for _ in range(3)], [400, 400, 429])
+
+    def test_needs_an_atomic_cache(self):
+        self.assertEqual([error.id for error in check_atomic_caches(None)], ['shop.E002'])
+        with override_settings(CACHES={'throttle': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}):
+            self.assertEqual(check_atomic_caches(None), [])
+
+    def test_spoofed_forwarded_for_is_throttled(self):
+        # The proxy appends the real address to whatever the client sent.
+        statuses = [
+            self.client.post('/api/users/verify/', data={'phone_number': f'0912000{i:04d}'}, format='json',
+                             HTTP_X_FORWARDED_FOR=f'203.0.113.{i}, 198.51.100.7').status_code
+            for i in range(5)
+        ]
+        self.assertEqual(statuses, [400, 400, 400, 400, 429])
+
+    def test_phone_number_formats_share_a_limit(self):
+        for phone_number in ['+989337905450', '00989337905450']:
+            self.client.post('/api/token/access/', data={'phone_number': phone_number, 'password': 'wrong'},
+                             format='json')
+        response = self.client.post('/api/token/access/', format='json',
+                                    data={'phone_number': self.user.phone_number, 'password': 'wrong'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_token_is_throttled_before_checking_the_password(self):
+        credentials = {'phone_number': self.user.phone_number, 'password': 'wrong'}
+        for _ in range(2):
+            self.client.post('/api/token/access/', data=credentials, format='json')
+        with mock.patch('accounts.models.User.check_password') as check_password:
+            response = self.client.post('/api/token/access/', data=credentials, format='json')
+        self.assertEqual(response.status_code, 429)
+        check_password.assert_not_called()
+
+
+class FakeKavenegar:
+    """Records the sends instead of making them, and fails the ones for which `fail` returns True."""
+
+    def __init__(self, fail=lambda params: False):
+        self.fail = fail
+        self.sent = []
+
+    def sms_send(self, params):
+        if self.fail(params):
+            raise kavenegar.HTTPException('Connection refused')
+        self.sent.append(params)
+        return [{'status': 1}]
+
+
+@override_settings(SMS_BATCH_SIZE=2, SMS_RETRY_BACKOFF=30, SMS_MAX_ATTEMPTS=2)
+class SMSOutboxTestCase(APITestCase):
+    def test_identical_texts_are_batched(self):
+        enqueue_sms(['09120000001', '09120000002', '09120000003'], 'Hello')
+        enqueue_sms(['09120000001'], 'Bye')
+
+        client = FakeKavenegar()
+        self.assertEqual(drain_outbox(client)[:2], (4, 0))
+        self.assertEqual(
+            sorted((params['message'], params['receptor']) for params in client.sent),
+            [('Bye', '09120000001'), ('Hello', '09120000001, 09120000002'), ('Hello', '09120000003')]
+        )
+        self.assertEqual(SMSMessage.objects.filter(state='SENT').count(), 4)
+        self.assertEqual(drain_outbox(client)[:2], (0, 0))
+
+    @override_settings(SMS_SEND_CONCURRENCY=4)
+    def test_requests_are_sent_concurrently(self):
+        enqueue_sms([f'0912000000{i}' for i in range(8)], 'Hello')
+        running, most = [], []
+
+        def fail(params):
+            running.append(params)
+            most.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+            return False
+
+        self.assertEqual(drain_outbox(FakeKavenegar(fail=fail))[:2], (8, 0))
+        self.assertGreater(max(most), 1)
+        self.assertLessEqual(max(most), 4)
+
+    @override_settings(SMS_BATCH_SIZE=1, SMS_SEND_CONCURRENCY=1, SMS_SEND_TIMEOUT=40, SMS_REQUEST_TIMEOUT=10)
+    def test_sends_stay_within_the_lease(self):
+        enqueue_sms(['09120000001', '09120000002', '09120000003', '09120000004'], 'Hello')
+        clock = [0]
+
+        def fail(params):
+            clock[0] += 16  # Slow requests: the third would start too late to finish within the lease.
+            return False
+
+        with mock.patch('accounts.sms.time.monotonic', side_effect=lambda: clock[0]):
+            self.assertEqual(drain_outbox(FakeKavenegar(fail=fail))[:2], (2, 0))
+        # Three claimed, at most one request per 10 s of the 40 s lease, and the unsent one handed back.
+        due = SMSMessage.objects.filter(state='PENDING', next_attempt__lte=timezone.now())
+        self.assertEqual(due.count(), 2)
+
+    def test_client_requests_time_out(self):
+        response = mock.Mock(content=b'{"return": {"status": 200, "message": ""}, "entries": [{"status": 1}]}')
+        with mock.patch('accounts.sms.requests.post', return_value=response) as post:
+            self.assertEqual(get_client().sms_send({'receptor': '09120000001', 'message': 'Hello'}), [{'status': 1}])
+        self.assertEqual(post.call_args.kwargs['timeout'], 10)
+
+    def test_failed_sends_are_retried_with_backoff(self):
+        enqueue_sms(['09120000001'], 'Hello')
+        self.assertEqual(drain_outbox(FakeKavenegar(fail=lambda params: True))[:2], (0, 1))
+        message = SMSMessage.objects.get()
+        self.assertEqual((message.state, message.attempts, message.last_error), ('PENDING', 1, 'Connection refused'))
+        self.assertGreater(message.next_attempt, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(drain_outbox(FakeKavenegar())[:2], (0, 0))  # Not due yet.
+
+        SMSMessage.objects.update(next_attempt=timezone.now())
+        drain_outbox(FakeKavenegar(fail=lambda params: True))
+        self.assertEqual(SMSMessage.objects.get().state, 'FAILED')
+
+    @override_settings(SMS_OUTBOX_MAX_PENDING=1)
+    def test_otp_is_refused_while_the_outbox_is_full(self):
+        User.objects.create_user(phone_number='09337905450', password='te123456', first_name='test',
+                                 last_name='test', email='test@gmail.com', is_active=False)
+        enqueue_sms(['09120000001'], 'Hello')
+        response = self.client.post('/api/users/verify/', data={'phone_number': '09337905450'}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertIsNone(User.objects.get().last_otp_sent)
+
+        with mock.patch('accounts.management.commands.drain_sms_outbox.get_client', return_value=FakeKavenegar()):
+            out = StringIO()
+            call_command('drain_sms_outbox', '--once', stdout=out)
+        self.assertIn('Sent 1 and failed 0 message(s)', out.getvalue())
+        response = self.client.post('/api/users/verify/', data={'phone_number': '09337905450'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(SMSMessage.objects.filter(state='PENDING', mobile='09337905450').count(), 1)
+
+    def test_worker_survives_losing_the_database(self):
+        command = 'accounts.management.commands.drain_sms_outbox'
+        results = [OperationalError('Lost connection to MySQL server'), (1, 0, [0.1]), KeyboardInterrupt()]
+        err = StringIO()
+        with mock.patch(f'{command}.drain_outbox', side_effect=results) as drain, \
+                mock.patch(f'{command}.close_old_connections') as close_old_connections, \
+                mock.patch(f'{command}.get_client'), mock.patch(f'{command}.time.sleep'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('drain_sms_outbox', stdout=StringIO(), stderr=err)
+        self.assertEqual(drain.call_count, 3)
+        # After the error, and after the busy round.
+        self.assertEqual(close_old_connections.call_count, 2)
+        self.assertIn('Lost connection to MySQL server', err.getvalue())
@@ -0,0 +1,97 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+THROTTLE_CACHE = 'throttle'
+
+
+def parse_rate(rate):
+    """Parse a rate like `5/min` or `20/hour` into (requests, seconds), like DRF's throttle rates."""
+    if not rate:
+        return None, None
+    num, period = rate.split('/')
+    return int(num), DURATIONS[period[0]]
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Throttles the requests of a client to the AUTH_THROTTLE_RATES rate of `<scope>_<kind>`, where the scope
+    is the view's `throttle_scope` or the viewset action.
+
+    Requests are counted per fixed window in the shared THROTTLE_CACHE, so the limit holds across gunicorn
+    workers. It needs atomic increments, so concurrent requests aren't undercounted, see
+    shop.throttling.check_atomic_caches.
+    The window is slid by weighting the count of the previous window by the part of it that is still within
+    the last `duration` seconds, which smooths out bursts at window boundaries.
+    """
+    kind = None
+
+    def get_key(self, request):
+        raise NotImplementedError('.get_key() must be overridden')
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None) or getattr(view, 'action', None)
+        self.num_requests, self.duration = parse_rate(settings.AUTH_THROTTLE_RATES.get(f'{scope}_{self.kind}'))
+        ident = self.get_key(request)
+        if self.num_requests is None or not ident:
+            return True
+
+        window, self.elapsed = divmod(time.time(), self.duration)
+        previous_key = f'throttle:{scope}:{self.kind}:{ident}:{int(window) - 1}'
+        current_key = f'throttle:{scope}:{self.kind}:{ident}:{int(window)}'
+        cache = caches[THROTTLE_CACHE]
+        counts = cache.get_many([previous_key, current_key])
+        self.previous, self.current = counts.get(previous_key, 0), counts.get(current_key, 0)
+        self.weight = 1 - self.elapsed / self.duration
+
+        if self.previous * self.weight + self.current >= self.num_requests:
+            return False
+
+        cache.add(current_key, 0, self.duration * 2)
+        try:
+            cache.incr(current_key)
+        except ValueError:
+            pass  # Evicted in between, the request is let through uncounted.
+        return True
+
+    def wait(self):
+        if self.current >= self.num_requests:
+            # Not before the next window, where this one's count is weighted down.
+            return math.ceil(self.duration - self.elapsed)
+        # Until the previous window's share drops enough for one more request.
+        share = (self.num_requests - self.current) / self.previous
+        return max(math.ceil((self.weight - share) * self.duration), 1)
+
+
+def normalize_phone_number(phone_number):
+    """The digits of a phone number, with +98, 0098 and 98 prefixes written as 0, like 09121234567."""
+    digits = ''.join(filter(str.isdigit, str(phone_number or '')))[:20]
+    if digits.startswith('0098'):
+        digits = digits[4:]
+    elif digits.startswith('98') and len(digits) == 12:
+        digits = digits[2:]
+    if len(digits) == 10 and digits.startswith('9'):
+        digits = '0' + digits
+    return digits
+
+
+class IPThrottle(SlidingWindowThrottle):
+    """Keyed by the client address, which is only taken from X-Forwarded-For as far as NUM_PROXIES trusts it."""
+    kind = 'ip'
+
+    def get_key(self, request):
+        return self.get_ident(request)
+
+
+class PhoneNumberThrottle(SlidingWindowThrottle):
+    """Keyed by the phone number in the request body, so one number can't be targeted from many addresses."""
+    kind = 'phone'
+
+    def get_key(self, request):
+        phone_number = request.data.get('phone_number') if hasattr(request.data, 'get') else None
+        return normalize_phone_number(phone_number)
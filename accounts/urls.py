@@ -2,7 +2,7 @@ from django.urls import path
 from rest_framework import routers
 
 from . import views
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, token_blacklist
+from rest_framework_simplejwt.views import TokenRefreshView, token_blacklist
 
 app_name = 'accounts'
 router = routers.DefaultRouter()
@@ -13,7 +13,7 @@ router.register('accessory', views.AccessoryViewSet, 'accessory')
 
 urlpatterns = [
                   # flush expired tokens on a daily basis.
-                  path('token/access/', TokenObtainPairView.as_view(), name='token'),
+                  path('token/access/', views.ThrottledTokenObtainPairView.as_view(), name='token'),
                   path('token/refresh/', TokenRefreshView.as_view(), name='refresh_token'),
                   path('token/blacklist/', token_blacklist, name='blacklist_token'),
               ] + router.urls
@@ -2,21 +2,28 @@ import secrets
 import string
 
 import pyotp
+from django.db import transaction
 from django.utils.timezone import now
 
 from django.contrib.auth.models import AnonymousUser
+from django.utils.decorators import method_decorator
 from rest_framework import viewsets, mixins, status
 from rest_framework.decorators import action
 from rest_framework.permissions import BasePermission, IsAdminUser
+from rest_framework_simplejwt.views import TokenObtainPairView
 
-from shop.models import Payment
-from shop.payments import ZarrinPal
+from shop.catalog import catalog_condition
+from shop.checkout import reserve_competition_checkout, initiate_payment, initiation_response
 from . import serializers
 from .models import User, Staff, FAQ, Accessory
 from rest_framework.response import Response
 
 from .serializers import FAQSerializer, AccessorySerializer, ResetPasswordByAdminSerializer
-from .sms import SMS_EXECUTOR, send_sms, OTP_VALIDITY_PERIOD, OTP_RESEND_DELAY
+from .sms import enqueue_sms, OTP_VALIDITY_PERIOD, OTP_RESEND_DELAY
+from .throttling import IPThrottle, PhoneNumberThrottle
+
+# Checked before the view runs, so a throttled request never gets to hash a password or write to the database.
+AUTH_THROTTLES = [IPThrottle, PhoneNumberThrottle]
 
 
 class IsSamePerson(BasePermission):
@@ -32,6 +39,7 @@ class IsSamePerson(BasePermission):
             return False
 
 
+@method_decorator(catalog_condition, name='list')
 class StaffViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = Staff.objects.all()
     serializer_class = serializers.StaffSerializer
@@ -82,52 +90,12 @@ class UserViewSet(mixins.UpdateModelMixin, mixins.RetrieveModelMixin,
     @action(methods=['POST'], detail=False, permission_classes=[IsSamePerson],
             serializer_class=None)
     def competition_signup(self, request):
-        user = request.user
-        if user.is_signed_up_for_competition:
-            return Response({"detail": "شما برای مسابقه قبلا ثبت نام کردید!", "suggestion": "kys"},
-                            status=status.HTTP_400_BAD_REQUEST)
-
-        # TODO: Move this shit to db
-        if User.objects.filter(is_signed_up_for_competition=True).count() >= 50:
-            return Response({"detail": "ظرفیت مسابقه پر شده است!"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # TODO: Duplicated code
-        zarrinpal = ZarrinPal()
-
-        # TODO: Move total price to env variables or even better, admin panel
-        # Also TODO: Don't be lazy
-        price = 50_000
-        zarrinpal_response = zarrinpal.create_payment(
-            amount=price,
-            mobile=user.phone_number,
-            email=user.email
-        )
-
-        payment = Payment.objects.create(
-            user=user,
-            total_price=price,
-            is_competition_payment=True
-        )
-
-        if zarrinpal_response['status'] == 'success':
-            authority = zarrinpal_response['authority']
-            payment.authority = authority
-            payment.pay_link = zarrinpal_response['link']
-            payment.save()
-
-            return Response({
-                "payment_url": payment.pay_link,
-                "authority": authority
-            }, status=status.HTTP_200_OK)
-        else:
-            payment.payment_state = "FAILED"
-            payment.save()
-            return Response({
-                "detail": "Payment initiation failed.",
-                "error": zarrinpal_response.get('error')
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    @action(methods=['POST'], detail=False, permission_classes=[],
+        payment = reserve_competition_checkout(request.user)
+        zarrinpal_response = initiate_payment(payment)
+        data, status_code = initiation_response(payment, zarrinpal_response)
+        return Response(data, status=status_code)
+
+    @action(methods=['POST'], detail=False, permission_classes=[], throttle_classes=AUTH_THROTTLES,
             serializer_class=serializers.UserRegistrationSerializer)
     def signup(self, request):
         serializer = serializers.UserRegistrationSerializer(data=request.data)
@@ -137,7 +105,7 @@ class UserViewSet(mixins.UpdateModelMixin, mixins.RetrieveModelMixin,
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @action(methods=['POST'], detail=False, permission_classes=[],
+    @action(methods=['POST'], detail=False, permission_classes=[], throttle_classes=AUTH_THROTTLES,
             serializer_class=serializers.SendVerificationSerializer)
     def verify(self, request):
         serializer = serializers.SendVerificationSerializer(data=request.data)
@@ -156,19 +124,20 @@ class UserViewSet(mixins.UpdateModelMixin, mixins.RetrieveModelMixin,
             secret_key = pyotp.random_base32()
             user.otp_code = secret_key
             user.last_otp_sent = now()
-            user.save()
 
             totp = pyotp.TOTP(secret_key, interval=OTP_VALIDITY_PERIOD)
             otp = totp.now()
 
-            mobiles = [user.phone_number, ]
-            SMS_EXECUTOR.submit(send_sms, mobiles, f"Your verification code is {otp}.")
+            with transaction.atomic():
+                user.save()
+                mobiles = [user.phone_number, ]
+                enqueue_sms(mobiles, f"Your verification code is {otp}.")
 
             return Response({"detail": "Verification code sent to your phone."}, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @action(methods=['POST'], detail=False, permission_classes=[],
+    @action(methods=['POST'], detail=False, permission_classes=[], throttle_classes=AUTH_THROTTLES,
             serializer_class=serializers.ActivateUserSerializer)
     def activate(self, request):
         serializer = serializers.ActivateUserSerializer(data=request.data)
@@ -197,11 +166,18 @@ class UserViewSet(mixins.UpdateModelMixin, mixins.RetrieveModelMixin,
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ThrottledTokenObtainPairView(TokenObtainPairView):
+    throttle_classes = AUTH_THROTTLES
+    throttle_scope = 'token'
+
+
+@method_decorator(catalog_condition, name='list')
 class FAQViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = FAQ.objects.all()
     serializer_class = FAQSerializer
 
 
+@method_decorator(catalog_condition, name='list')
 class AccessoryViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = Accessory.objects.all()
     serializer_class = AccessorySerializer
@@ -48,8 +48,50 @@ USE_X_FORWARDED_HOST = True
 SMS_KEY = os.getenv("SMS_KEY", default="key")
 SMS_LINE_NUMBER = os.getenv("SMS_LINE_NUMBER", default="300")
 
+# The SMS outbox, see accounts.sms. Kavenegar takes up to 200 receptors per request. A worker sends
+# SMS_SEND_CONCURRENCY requests at a time, each given up after SMS_REQUEST_TIMEOUT seconds, and leases the
+# messages it claims for SMS_SEND_TIMEOUT seconds.
+SMS_BATCH_SIZE = int(os.getenv("SMS_BATCH_SIZE", default=200))
+SMS_MAX_ATTEMPTS = int(os.getenv("SMS_MAX_ATTEMPTS", default=5))
+SMS_RETRY_BACKOFF = int(os.getenv("SMS_RETRY_BACKOFF", default=30))
+SMS_SEND_CONCURRENCY = int(os.getenv("SMS_SEND_CONCURRENCY", default=10))
+SMS_REQUEST_TIMEOUT = int(os.getenv("SMS_REQUEST_TIMEOUT", default=10))
+SMS_SEND_TIMEOUT = int(os.getenv("SMS_SEND_TIMEOUT", default=60))
+# Messages a worker sends per second, as reported by drain_sms_outbox. OTPs are refused while the queue holds
+# more than the worker sends in a quarter of their 120 s validity, so the ones that are queued arrive in time.
+SMS_SEND_RATE = float(os.getenv("SMS_SEND_RATE", default=20))
+SMS_OUTBOX_MAX_PENDING = int(os.getenv("SMS_OUTBOX_MAX_PENDING", default=SMS_SEND_RATE * 30))
+
 PAYMENT_API_KEY = os.getenv("PAYMENT_API_KEY", default="auth")
 PAYMENT_CALLBACK_URL = os.getenv("PAYMENT_CALLBACK_URL", default="callback")
+PAYMENT_GATEWAY_URL = os.getenv("PAYMENT_GATEWAY_URL", default="https://payment.zarinpal.com")
+
+# Seconds a seat is held for a participation in a cart, and for one whose checkout went to the gateway.
+SEAT_HOLD_SECONDS = int(os.getenv("SEAT_HOLD_SECONDS", default=15 * 60))
+SEAT_HOLD_CHECKOUT_SECONDS = int(os.getenv("SEAT_HOLD_CHECKOUT_SECONDS", default=30 * 60))
+
+# Clients let into add_participation (per presentation) and pay_all per second, after a burst, see
+# shop.throttling. A rate of 0 turns the waiting room off. It needs a Redis cache at WAITING_ROOM_CACHE_URL
+# (e.g. redis://redis:6379/1), so it is off unless that is set.
+WAITING_ROOM_CACHE_URL = os.getenv("WAITING_ROOM_CACHE_URL")
+WAITING_ROOM_RATE = float(os.getenv("WAITING_ROOM_RATE", default=20 if WAITING_ROOM_CACHE_URL else 0))
+WAITING_ROOM_BURST = int(os.getenv("WAITING_ROOM_BURST", default=100))
+WAITING_ROOM_ADMISSION_SECONDS = int(os.getenv("WAITING_ROOM_ADMISSION_SECONDS", default=10 * 60))
+
+# Requests per IP address and per phone number to the signup, OTP, activation and token endpoints, see
+# accounts.throttling. A missing rate turns that throttle off. The counters need a Redis cache at
+# THROTTLE_CACHE_URL, by default the waiting room's, so the rates are off unless there is one.
+THROTTLE_CACHE_URL = os.getenv("THROTTLE_CACHE_URL", default=WAITING_ROOM_CACHE_URL)
+AUTH_THROTTLE_RATES = {} if not THROTTLE_CACHE_URL else {
+    'signup_ip': os.getenv("SIGNUP_IP_THROTTLE_RATE", default='20/hour'),
+    'signup_phone': os.getenv("SIGNUP_PHONE_THROTTLE_RATE", default='5/hour'),
+    'verify_ip': os.getenv("VERIFY_IP_THROTTLE_RATE", default='20/hour'),
+    'verify_phone': os.getenv("VERIFY_PHONE_THROTTLE_RATE", default='5/hour'),
+    'activate_ip': os.getenv("ACTIVATE_IP_THROTTLE_RATE", default='30/hour'),
+    'activate_phone': os.getenv("ACTIVATE_PHONE_THROTTLE_RATE", default='10/hour'),
+    'token_ip': os.getenv("TOKEN_IP_THROTTLE_RATE", default='60/hour'),
+    'token_phone': os.getenv("TOKEN_PHONE_THROTTLE_RATE", default='10/hour'),
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
@@ -64,6 +106,9 @@ REST_FRAMEWORK = {
         'rest_framework.parsers.FormParser',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    # Reverse proxies in front of the app. Throttles take the client address the last one appended to
+    # X-Forwarded-For, as anything before it is up to the client.
+    'NUM_PROXIES': int(os.getenv("NUM_PROXIES", default=1)),
     'DATETIME_FORMAT': "%Y-%m-%dT%H:%M:%S.%f%z",
 }
 
@@ -131,6 +176,26 @@ DATABASES = {
     },
 }
 
+# Shared between gunicorn workers, the database cache needs `python manage.py createcachetable`.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'cache_table'),
+    },
+}
+if WAITING_ROOM_CACHE_URL:
+    # Atomic increments for the waiting room's tickets, see shop.throttling.
+    CACHES['waiting_room'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': WAITING_ROOM_CACHE_URL,
+    }
+if THROTTLE_CACHE_URL:
+    # Atomic increments for the auth throttles' counters, see accounts.throttling.
+    CACHES['throttle'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': THROTTLE_CACHE_URL,
+    }
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -0,0 +1,111 @@
+"""
+Time the Payment, Participation and User admin changelists with exact counts and with the estimated counts
+of EstimatedCountPaginator. The estimates only kick in on MySQL, so configure a MySQL database. Runs against
+a throwaway test database seeded with `--users` users:
+
+    python benchmarks/admin_changelist.py --users 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib import admin  # noqa: E402
+from django.core.paginator import Paginator  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from accounts.models import User  # noqa: E402
+from shop.models import Presentation, Participation, Payment  # noqa: E402
+
+URLS = {
+    'payments': '/admin/shop/payment/',
+    'failed payments': '/admin/shop/payment/?payment_state__exact=FAILED',
+    'participations': '/admin/shop/participation/',
+    'users': '/admin/accounts/user/',
+    'user search': '/admin/accounts/user/?q=0912000',
+}
+
+
+def seed(users, batch_size=5000):
+    start = timezone.now() + timedelta(days=7)
+    presentation = Presentation.objects.create(
+        service_type='WORKSHOP', en_title='Bench', fa_title='Bench', start=start, end=start + timedelta(hours=2),
+        en_description='', fa_description='', capacity=users, cost=100_000,
+    )
+    for offset in range(0, users, batch_size):
+        created = User.objects.bulk_create([
+            User(phone_number=f'0912{i:07d}', first_name='bench', last_name='bench', email=f'bench{i}@example.com',
+                 password='!', is_active=True)
+            for i in range(offset, min(offset + batch_size, users))
+        ])
+        Participation.objects.bulk_create([Participation(user=user, presentation=presentation,
+                                                          payment_state='COMPLETED') for user in created])
+        Payment.objects.bulk_create([
+            Payment(user=user, total_price=100_000, authority=f'A{user.pk:035d}',
+                    payment_state=random.choice(['PENDING', 'COMPLETED', 'FAILED']))
+            for user in created
+        ])
+    if connection.vendor == 'mysql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE TABLE accounts_user, shop_participation, shop_payment')
+
+
+def measure(client, runs):
+    for name, url in URLS.items():
+        latencies = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            assert client.get(url).status_code == 200
+            latencies.append(time.perf_counter() - started)
+        print(f'  {name}: median {statistics.median(latencies) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        seed(args.users)
+        client = Client()
+        client.force_login(User.objects.create_superuser(
+            phone_number='09100000000', password='bench', first_name='bench', last_name='bench',
+            email='admin@example.com',
+        ))
+
+        model_admins = [admin.site._registry[model] for model in (Payment, Participation, User)]
+        patches = [mock.patch.object(model_admin, 'paginator', Paginator) for model_admin in model_admins]
+        patches += [mock.patch.object(model_admin, 'show_full_result_count', True) for model_admin in model_admins]
+        for patch in patches:
+            patch.start()
+        print(f'{connection.vendor}, {args.users} users, exact counts:')
+        measure(client, args.runs)
+        for patch in patches:
+            patch.stop()
+
+        print('estimated counts:')
+        measure(client, args.runs)
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
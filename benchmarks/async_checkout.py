@@ -0,0 +1,147 @@
+"""
+Compare checkout throughput of the sync views under gunicorn's sync workers with the async views under
+uvicorn workers, against the fake gateway of shop.fake_gateway with injected latency. Needs gunicorn and
+uvicorn:
+
+    pip install gunicorn uvicorn
+    python benchmarks/async_checkout.py --latency 0.5 --concurrency 200 --requests 1000
+
+It seeds users with pending participations in the configured database and removes them afterwards, so
+point DB_NAME at a throwaway database that has been migrated.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import httpx  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from accounts.models import User  # noqa: E402
+from shop.fake_gateway import FakeGateway, parse_latency  # noqa: E402
+from shop.models import Presentation, Participation  # noqa: E402
+
+PHONE_PREFIX = '0999'
+
+
+def seed(users):
+    start = timezone.now() + timedelta(days=1)
+    presentation = Presentation.objects.create(
+        service_type='WORKSHOP', en_title='Benchmark', fa_title='Benchmark', start=start,
+        end=start + timedelta(hours=1), en_description='', fa_description='', capacity=users, cost=100_000,
+    )
+    tokens = []
+    for i in range(users):
+        user = User.objects.create_user(phone_number=f'{PHONE_PREFIX}{i:07d}', password='bench-password',
+                                        first_name='bench', last_name='bench', email=f'bench{i}@example.com',
+                                        is_active=True)
+        Participation.objects.create(user=user, presentation=presentation)
+        tokens.append(str(AccessToken.for_user(user)))
+    return presentation, tokens
+
+
+def cleanup(presentation):
+    User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+    presentation.delete()
+
+
+def start_server(args, port, gateway_url):
+    command = ['gunicorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}', '--log-level', 'warning']
+    if args.mode == 'asgi':
+        command += ['--worker-class', 'uvicorn.workers.UvicornWorker', 'backend.asgi:application']
+    else:
+        command += ['backend.wsgi:application']
+    # Without the waiting room, which would answer most of a burst of checkouts with 429.
+    env = dict(os.environ, PAYMENT_GATEWAY_URL=gateway_url, WAITING_ROOM_RATE='0')
+    server = subprocess.Popen(command, cwd=BASE_DIR, env=env)
+    for _ in range(100):
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/api/presenter/')
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'{args.mode} server did not start')
+
+
+async def load(url, tokens, requests, concurrency):
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def checkout(i):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, json={},
+                                                 headers={'Authorization': f'Bearer {tokens[i % len(tokens)]}'})
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(checkout(i) for i in range(requests)))
+        return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', default='0.5',
+                        help='Gateway latency in seconds, e.g. 0.5 or lognormal:0.5,0.4.')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', choices=['wsgi', 'asgi', 'both'], default='both')
+    parser.add_argument('--port', type=int, default=8100)
+    args = parser.parse_args()
+
+    gateway = FakeGateway(latency=parse_latency(args.latency))
+    gateway_url = gateway.start()
+
+    presentation, tokens = seed(args.concurrency)
+    try:
+        for mode in (['wsgi', 'asgi'] if args.mode == 'both' else [args.mode]):
+            args.mode = mode
+            server = start_server(args, args.port, gateway_url)
+            path = '/api/async/payments/pay_all/' if mode == 'asgi' else '/api/payments/pay_all/'
+            try:
+                latencies, errors, elapsed = asyncio.run(
+                    load(f'http://127.0.0.1:{args.port}{path}', tokens, args.requests, args.concurrency)
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+            latencies.sort()
+            p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0
+            print(f'{mode}: {args.workers} workers, {args.requests} checkouts at concurrency {args.concurrency}, '
+                  f'gateway latency {args.latency}')
+            print(f'  {len(latencies) / elapsed:.1f} checkouts/s, '
+                  f'median {statistics.median(latencies or [0]) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, '
+                  f'{errors} errors')
+    finally:
+        cleanup(presentation)
+        gateway.stop()
+
+
+if __name__ == '__main__':
+    main()
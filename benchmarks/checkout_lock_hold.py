@@ -0,0 +1,92 @@
+"""
+Measure how long `payments/pay_all/` keeps a transaction, and so its row locks, open while the payment
+gateway is slow. The gateway is the fake gateway of shop.fake_gateway, answering after --latency seconds.
+Runs against a throwaway test database created from the configured settings:
+
+    python benchmarks/checkout_lock_hold.py --latency 0.5 --requests 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from accounts.models import User  # noqa: E402
+from shop.fake_gateway import FakeGateway, fixed, REQUEST_PATH  # noqa: E402
+from shop.models import Presentation, Participation  # noqa: E402
+from shop.payments import ZarrinPal  # noqa: E402
+
+
+class TransactionTimer:
+    """Times every transaction from its first statement until it commits."""
+
+    def __init__(self):
+        self.started = None
+        self.windows = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if connection.in_atomic_block and self.started is None:
+            self.started = time.perf_counter()
+            connection.on_commit(self.committed)
+        return execute(sql, params, many, context)
+
+    def committed(self):
+        self.windows.append(time.perf_counter() - self.started)
+        self.started = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.5, help='Gateway latency in seconds.')
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        user = User.objects.create_user(phone_number='09120000000', password='bench-password', first_name='bench',
+                                        last_name='bench', email='bench@example.com', is_active=True)
+        start = timezone.now() + timedelta(days=1)
+        for i in range(3):
+            presentation = Presentation.objects.create(
+                service_type='WORKSHOP', en_title=f'Bench {i}', fa_title=f'Bench {i}', start=start,
+                end=start + timedelta(hours=1), en_description='', fa_description='', capacity=1000, cost=100_000,
+            )
+            Participation.objects.create(user=user, presentation=presentation)
+
+        client = APIClient()
+        client.force_authenticate(user)
+        lock_holds = []
+        with FakeGateway(latency=fixed(args.latency)) as gateway, \
+                mock.patch.object(ZarrinPal, 'PAY_URL', gateway.url + REQUEST_PATH):
+            for _ in range(args.requests):
+                timer = TransactionTimer()
+                with connection.execute_wrapper(timer):
+                    response = client.post('/api/payments/pay_all/', data={}, format='json')
+                assert response.status_code == 200, response.content
+                lock_holds.append(max(timer.windows))
+
+        print(f'gateway latency {args.latency * 1000:.0f} ms, {args.requests} checkouts')
+        print(f'longest transaction per checkout: median {statistics.median(lock_holds) * 1000:.1f} ms, '
+              f'max {max(lock_holds) * 1000:.1f} ms')
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
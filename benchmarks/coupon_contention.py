@@ -0,0 +1,141 @@
+"""
+Measure checkout and verification throughput when every checkout uses the same coupon code, with coupon
+redemption as it was (a locked coupon row during checkout and a locked read-modify-write at verify time)
+and as it is (a lock-free check during checkout and a conditional decrement at verify time). Needs a
+database with row locks, so MySQL, and runs against a throwaway test database:
+
+    python benchmarks/coupon_contention.py --checkouts 200 --gateway-latency 0.3
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection, transaction  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from accounts.models import User  # noqa: E402
+from shop import checkout  # noqa: E402
+from shop.models import Presentation, Participation, Payment, Coupon  # noqa: E402
+
+CODE = 'BENCH'
+
+original_reserve_checkout = checkout.reserve_checkout
+
+
+def locked_reserve_checkout(user, coupon_code=None, accessory_ids=()):
+    """Checkout as it was: the coupon row stays locked until the reservation commits."""
+    with transaction.atomic():
+        Coupon.objects.select_for_update().filter(name=coupon_code, count__gt=0).first()
+        return original_reserve_checkout(user, coupon_code, accessory_ids)
+
+
+def locked_redeem(name, count=1):
+    """Redemption as it was: a read-modify-write of the locked coupon row."""
+    coupon = Coupon.objects.select_for_update().get(pk=name)
+    coupon.count -= count
+    coupon.save()
+    return True
+
+
+def seed(checkouts):
+    start = timezone.now() + timedelta(days=7)
+    presentation = Presentation.objects.create(
+        service_type='WORKSHOP', en_title='Bench', fa_title='Bench', start=start, end=start + timedelta(hours=2),
+        en_description='', fa_description='', capacity=checkouts * 2, cost=100_000,
+    )
+    User.objects.bulk_create([
+        User(phone_number=f'0912{i:07d}', first_name='bench', last_name='bench', email=f'bench{i}@example.com',
+             password='!', is_active=True)
+        for i in range(checkouts)
+    ])
+    return presentation, list(User.objects.filter(phone_number__startswith='0912'))
+
+
+class SlowGateway:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def verify_payment(self, authority, amount):
+        time.sleep(self.latency)
+        return {'status': 'success', 'ref_id': 1, 'error': None, 'card_pan': '6037'}
+
+
+def run(users, presentation, threads, gateway_latency):
+    Participation.objects.all().delete()
+    Payment.objects.all().delete()
+    Coupon.objects.update_or_create(name=CODE, defaults={'count': len(users), 'percentage': 20})
+    Participation.objects.bulk_create([Participation(user=user, presentation=presentation) for user in users])
+
+    gateway = SlowGateway(gateway_latency)
+
+    def pay(user):
+        try:
+            started = time.perf_counter()
+            payment = checkout.reserve_checkout(user, CODE)
+            reserved = time.perf_counter() - started
+            payment.authority = f'A{payment.pk:035d}'
+            payment.save(update_fields=['authority'])
+
+            started = time.perf_counter()
+            checkout.verify_payment(payment, zarrinpal=gateway)
+            return reserved, time.perf_counter() - started
+        finally:
+            connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(pay, users))
+    return time.perf_counter() - started, latencies
+
+
+def report(mode, elapsed, latencies, checkouts):
+    def summary(values):
+        values = sorted(values)
+        return f'median {statistics.median(values) * 1000:.1f} ms, p95 {values[int(len(values) * 0.95)] * 1000:.1f} ms'
+
+    print(f'{mode}: {checkouts / elapsed:.1f} checkouts/s, coupons left {Coupon.objects.get(name=CODE).count}')
+    print(f'  reserve {summary(latency for latency, _ in latencies)}')
+    print(f'  verify {summary(latency for _, latency in latencies)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkouts', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=200)
+    parser.add_argument('--gateway-latency', type=float, default=0.3, help='Verification latency in seconds.')
+    args = parser.parse_args()
+
+    if connection.vendor == 'sqlite':
+        sys.exit('SQLite has no row locks to contend on, configure a MySQL database.')
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        presentation, users = seed(args.checkouts)
+        with mock.patch.object(checkout, 'reserve_checkout', locked_reserve_checkout), \
+                mock.patch.object(Coupon, 'redeem', staticmethod(locked_redeem)):
+            elapsed, latencies = run(users, presentation, args.threads, args.gateway_latency)
+        report('locked coupon', elapsed, latencies, args.checkouts)
+
+        elapsed, latencies = run(users, presentation, args.threads, args.gateway_latency)
+        report('conditional decrement', elapsed, latencies, args.checkouts)
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
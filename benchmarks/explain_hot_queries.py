@@ -0,0 +1,117 @@
+"""
+Print the EXPLAIN plans of the hot Participation and Payment lookups, without and with the indexes of
+shop migration 0022. Seeds a throwaway test database created from the configured settings (MySQL in
+production) with a dataset about the size of a festival:
+
+    python benchmarks/explain_hot_queries.py --users 20000 --presentations 80
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from accounts.models import User  # noqa: E402
+from shop.models import Presentation, Participation, Payment, Coupon  # noqa: E402
+
+BEFORE = '0021_participation_held_until'
+AFTER = '0022_hot_lookup_indexes'
+
+
+def seed(users, presentations, batch_size=2000):
+    start = timezone.now() + timedelta(days=7)
+    Presentation.objects.bulk_create([
+        Presentation(service_type='WORKSHOP', en_title=f'Bench {i}', fa_title=f'Bench {i}', start=start,
+                     end=start + timedelta(hours=2), en_description='', fa_description='', capacity=500,
+                     cost=100_000)
+        for i in range(presentations)
+    ])
+    User.objects.bulk_create([
+        User(phone_number=f'0912{i:07d}', first_name='bench', last_name='bench', email=f'bench{i}@example.com',
+             password='!', is_active=True)
+        for i in range(users)
+    ], batch_size=batch_size)
+    Coupon.objects.bulk_create([Coupon(name=f'BENCH{i}', count=100, percentage=10) for i in range(20)])
+
+    presentation_ids = list(Presentation.objects.values_list('id', flat=True))
+    user_ids = list(User.objects.values_list('id', flat=True))
+    coupons = list(Coupon.objects.values_list('name', flat=True))
+    participations, payments = [], []
+    for user_id in user_ids:
+        for presentation_id in random.sample(presentation_ids, random.randint(1, 4)):
+            participations.append(Participation(user_id=user_id, presentation_id=presentation_id,
+                                                payment_state=random.choice(['PENDING', 'COMPLETED', 'FAILED'])))
+        for _ in range(random.randint(0, 3)):
+            payments.append(Payment(user_id=user_id, total_price=100_000, authority=f'A{len(payments):035d}',
+                                    payment_state=random.choice(['PENDING', 'COMPLETED', 'FAILED']),
+                                    coupon_id=random.choice(coupons) if random.random() < 0.2 else None))
+    Participation.objects.bulk_create(participations, batch_size=batch_size)
+    Payment.objects.bulk_create(payments, batch_size=batch_size)
+    return len(participations), len(payments)
+
+
+def hot_queries():
+    user = User.objects.order_by('id')[User.objects.count() // 2]
+    presentation = Presentation.objects.order_by('id').first()
+    payment = Payment.objects.order_by('id')[Payment.objects.count() // 2]
+    return [
+        ('cart and checkout', Participation.objects.filter(user=user, payment_state='PENDING')),
+        ('registrations', Participation.objects.filter(presentation=presentation, payment_state='COMPLETED')),
+        ('add participation', Participation.objects.filter(user=user, presentation=presentation)),
+        ('verify', Payment.objects.filter(authority=payment.authority)),
+        ('payment history', Payment.objects.filter(user=user).order_by('-created_date')),
+        ('coupon uses', Payment.objects.filter(coupon_id='BENCH0', payment_state='COMPLETED')),
+    ]
+
+
+def explain(title, queries):
+    if connection.vendor == 'mysql':
+        # Fresh statistics, so the plans reflect the seeded data.
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE TABLE shop_participation, shop_payment')
+
+    print(f'=== {title}')
+    for name, queryset in queries:
+        print(f'--- {name}: {queryset.query}')
+        print(queryset.explain())
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--presentations', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        participations, payments = seed(args.users, args.presentations)
+        print(f'{connection.vendor}: {args.users} users, {participations} participations, {payments} payments\n')
+
+        queries = hot_queries()
+        call_command('migrate', 'shop', BEFORE, verbosity=0)
+        explain(f'before ({BEFORE})', queries)
+        call_command('migrate', 'shop', AFTER, verbosity=0)
+        explain(f'after ({AFTER})', queries)
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
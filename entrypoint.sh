@@ -1,7 +1,26 @@
 #!/bin/sh
 
+# The background workers run as services of their own, from the same image, so the orchestrator restarts
+# them when they exit instead of them dying unnoticed behind gunicorn:
+#
+#     ./entrypoint.sh sms-worker
+#     ./entrypoint.sh seat-hold-sweeper
+#     ./entrypoint.sh payment-initiation-worker
+case "$1" in
+    sms-worker)
+        exec python manage.py drain_sms_outbox
+        ;;
+    seat-hold-sweeper)
+        exec python manage.py release_expired_seat_holds --loop --interval "${SEAT_HOLD_SWEEP_INTERVAL:-30}"
+        ;;
+    payment-initiation-worker)
+        exec python manage.py process_payment_initiations --loop --interval "${PAYMENT_INITIATION_INTERVAL:-30}"
+        ;;
+esac
+
 python manage.py makemigrations accounts
 python manage.py makemigrations shop
 python manage.py migrate
+python manage.py createcachetable
 
-gunicorn --env DJANGO_SETTINGS_MODULE=backend.settings backend.wsgi:application --bind 0.0.0.0:8000
\ No newline at end of file
+exec gunicorn --env DJANGO_SETTINGS_MODULE=backend.settings backend.wsgi:application --bind 0.0.0.0:8000
@@ -1,74 +1,166 @@
-from django.contrib import admin
-from django.http import JsonResponse
+import time
+
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME, ActionForm
+from django.db.models import Count, Q
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.template.defaultfilters import title
 
-from accounts.sms import SMS_EXECUTOR, send_sms
-from shop.models import Presenter, Presentation, Participation, Coupon, Payment, PresentationTag
+from accounts.sms import enqueue_sms
+from shop.exports import write_coupons, registration_rows, stream_csv, stream_json_lines, REGISTRATION_FIELDS
+from shop.models import Presenter, Presentation, Participation, Coupon, Payment, PresentationTag, WaitlistEntry
+from shop.pagination import EstimatedCountPaginator
 
 admin.site.register(Presenter)
 admin.site.register(PresentationTag)
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
-    search_fields = ['user__phone_number']
+    search_fields = ['^user__phone_number', '=authority']
+    list_select_related = ['user']
+    autocomplete_fields = ['user', 'coupon', 'participations']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 @admin.register(Participation)
 class ParticipationAdmin(admin.ModelAdmin):
-    search_fields = ['user__phone_number']
+    search_fields = ['^user__phone_number']
     list_display = ['__str__','payment_state', 'presentation__cost']
+    autocomplete_fields = ['user', 'presentation']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # For the changelist and for the autocomplete of payments, which both show __str__.
+        return super().get_queryset(request).select_related('user', 'presentation')
+
+@admin.register(WaitlistEntry)
+class WaitlistEntryAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'created_date']
+    list_filter = ['presentation']
+    list_select_related = ['user', 'presentation']
+    search_fields = ['^user__phone_number']
+    autocomplete_fields = ['user', 'presentation']
+
+
+class CouponActionForm(ActionForm):
+    count = forms.IntegerField(min_value=1, max_value=100_000, required=False)
+    prefix = forms.CharField(max_length=40, required=False)
+    percentage = forms.IntegerField(min_value=0, max_value=100, required=False)
+    uses = forms.IntegerField(min_value=1, initial=1, required=False)
+
+
+def coupons_csv(coupons, filename):
+    response = HttpResponse(content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    write_coupons(response, coupons)
+    return response
 
 
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
-    list_display = ('name', 'used')
+    list_display = ('name', 'percentage', 'count', 'used')
+    search_fields = ['^name']
+    action_form = CouponActionForm
+    actions = ('generate_coupons', 'export_coupons')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            used_count=Count('payment', filter=Q(payment__payment_state="COMPLETED"))
+        )
 
+    @admin.display(ordering='used_count')
     def used(self, obj):
-        return Payment.objects.filter(payment_state="COMPLETED", coupon=obj).count()
+        return obj.used_count
+
+    def changelist_view(self, request, extra_context=None):
+        # Generating coupons doesn't act on selected ones, so it runs without a selection too.
+        if (request.method == 'POST' and request.POST.get('action') == 'generate_coupons'
+                and not request.POST.getlist(ACTION_CHECKBOX_NAME) and self.has_add_permission(request)):
+            return self.generate_coupons(request, Coupon.objects.none()) or HttpResponseRedirect(request.path)
+        return super().changelist_view(request, extra_context)
+
+    @admin.action(description='Generate coupons', permissions=['add'])
+    def generate_coupons(self, request, queryset):
+        form = self.action_form(request.POST)
+        form.fields['action'].choices = self.get_action_choices(request)
+        if not form.is_valid() or not form.cleaned_data['count'] or form.cleaned_data['percentage'] is None:
+            self.message_user(request, 'Enter the number of coupons to generate and their percentage.',
+                              messages.ERROR)
+            return
+
+        prefix = form.cleaned_data['prefix']
+        try:
+            coupons = Coupon.objects.generate(
+                form.cleaned_data['count'],
+                prefix=prefix,
+                percentage=form.cleaned_data['percentage'],
+                uses=form.cleaned_data['uses'] or 1,
+            )
+        except ValueError as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return
+        return coupons_csv(coupons, f'{prefix.rstrip("-") or "generated"}-coupons.csv')
+
+    @admin.action(description='Export coupons as CSV')
+    def export_coupons(self, request, queryset):
+        return coupons_csv(queryset.iterator(), 'coupons.csv')
 
 
 @admin.register(Presentation)
 class PresentationAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'capacity', 'get_remained_capacity', 'get_presenters')
-    actions = ('send_registration_sms', 'export_registrations')
+    search_fields = ['en_title', 'fa_title']
+    actions = ('send_registration_sms', 'export_registrations', 'export_registrations_json_lines')
 
     class Meta:
         model = Presentation
         fields = '__all__'
 
+    def get_queryset(self, request):
+        # get_remained_capacity reads the seat counters, so the presenters are all that's left to fetch.
+        return super().get_queryset(request).prefetch_related('presenters')
+
     def get_presenters(self, obj):
         return ", ".join([str(presenter) for presenter in obj.presenters.all()])
 
     get_presenters.short_description = 'Presenters'
 
     @admin.action(description='Send registration sms')
-    def send_registration_sms(self, request, obj):
-        for presentation in obj:
-            mobiles = {
-                str(participation.user.phone_number)
-                for participation in Participation.objects.filter(
-                    payment_state="COMPLETED",
-                )
-            }
+    def send_registration_sms(self, request, queryset):
+        started = time.monotonic()
+        queued = 0
+        for presentation in queryset:
+            mobiles = Participation.objects.filter(
+                presentation=presentation, payment_state="COMPLETED"
+            ).values_list('user__phone_number', flat=True).distinct()
 
             message_text = (
                 f"Dear User, this is a friendly reminder to join us for the upcoming presentation '{presentation.en_title}'. "
                 f"We look forward to your participation! Date: {presentation.start}"
             )
 
-            if mobiles:
-                SMS_EXECUTOR.submit(send_sms, list(mobiles), message_text)
+            # Queued for the SMS outbox worker, which sends it in requests of up to SMS_BATCH_SIZE numbers.
+            queued += len(enqueue_sms(mobiles, message_text, check_backlog=False))
 
-    @admin.action(description='Export registrations')
-    def export_registrations(self, request, queryset):
-        data = {}
+        self.message_user(
+            request, f'Queued {queued} reminder SMS for {len(queryset)} presentation(s) in '
+                     f'{time.monotonic() - started:.2f} s.', messages.SUCCESS
+        )
 
-        for presentation in queryset:
-            data[presentation.en_title] = {}
-            for participation in Participation.objects.filter(payment_state="COMPLETED"):
-                user = participation.user
-                data[presentation.en_title][user.phone_number] = {
-                    'name': user.first_name + " " + user.last_name,
-                    'email': user.email,
-                }
-
-        return JsonResponse(data)
+    @admin.action(description='Export registrations as CSV')
+    def export_registrations(self, request, queryset):
+        response = StreamingHttpResponse(
+            stream_csv(registration_rows(queryset), REGISTRATION_FIELDS), content_type='text/csv'
+        )
+        response['Content-Disposition'] = 'attachment; filename="registrations.csv"'
+        return response
+
+    @admin.action(description='Export registrations as JSON lines')
+    def export_registrations_json_lines(self, request, queryset):
+        response = StreamingHttpResponse(
+            stream_json_lines(registration_rows(queryset)), content_type='application/jsonl'
+        )
+        response['Content-Disposition'] = 'attachment; filename="registrations.jsonl"'
+        return response
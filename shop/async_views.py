@@ -0,0 +1,122 @@
+"""
+Async variants of the payment endpoints. They await the gateway with AsyncZarrinPal and only touch the
+database in short sync sections, so under ASGI a worker isn't tied up while a gateway call is in flight.
+"""
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+
+from accounts.views import IsSamePerson
+from .checkout import CheckoutError, reserve_checkout, reserve_competition_checkout, record_initiation, \
+    initiated_response, initiation_response, record_verification, verification_response
+from .models import Payment
+from .payments import AsyncZarrinPal
+from .serializers import PayAllSerializer, PaymentVerifySerializer
+from .throttling import WaitingRoomThrottle
+
+
+@sync_to_async
+def check_request(request, action, permission_classes=(), throttle_classes=()):
+    """
+    Run `request` through the authentication, permission and throttle checks of a DRF view for `action`, the
+    same ones as the sync viewsets, and parse its body with DRF's parsers. Returns the DRF request and None,
+    or None and DRF's error response.
+    """
+    view = APIView(action=action, args=(), kwargs={}, permission_classes=permission_classes,
+                   throttle_classes=throttle_classes)
+    view.request = view.initialize_request(request)
+    view.headers = view.default_response_headers
+    try:
+        view.initial(view.request)
+        view.request.data  # Parsed here, so a malformed body gets DRF's 400 too.
+    except Exception as exc:
+        response = view.finalize_response(view.request, view.handle_exception(exc))
+        return None, response.render()
+    return view.request, None
+
+
+async def initiate(payment):
+    if payment.pay_link:
+        data, status_code = initiation_response(payment, initiated_response(payment))
+        return JsonResponse(data, status=status_code)
+    async with AsyncZarrinPal() as zarrinpal:
+        zarrinpal_response = await zarrinpal.create_payment(
+            amount=payment.total_price,
+            mobile=payment.user.phone_number,
+            email=payment.user.email
+        )
+    zarrinpal_response = await sync_to_async(record_initiation)(payment, zarrinpal_response)
+    data, status_code = initiation_response(payment, zarrinpal_response)
+    return JsonResponse(data, status=status_code)
+
+
+@csrf_exempt
+@require_POST
+async def pay_all(request):
+    request, error = await check_request(request, 'pay_all', [IsAuthenticated], [WaitingRoomThrottle])
+    if error:
+        return error
+
+    serializer = PayAllSerializer(data=request.data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        payment = await sync_to_async(reserve_checkout)(
+            request.user, serializer.validated_data.get('coupon', None),
+            serializer.validated_data.get('accessories', [])
+        )
+    except CheckoutError as e:
+        return JsonResponse(e.detail, status=e.status_code)
+    if payment is None:
+        return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+    return await initiate(payment)
+
+
+@csrf_exempt
+@require_POST
+async def competition_signup(request):
+    request, error = await check_request(request, 'competition_signup', [IsSamePerson])
+    if error:
+        return error
+
+    try:
+        payment = await sync_to_async(reserve_competition_checkout)(request.user)
+    except CheckoutError as e:
+        return JsonResponse(e.detail, status=e.status_code)
+
+    return await initiate(payment)
+
+
+@csrf_exempt
+@require_POST
+async def verify(request):
+    request, error = await check_request(request, 'verify')
+    if error:
+        return error
+
+    serializer = PaymentVerifySerializer(data=request.data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        payment = await Payment.objects.aget(authority=serializer.validated_data['authority'])
+    except Payment.DoesNotExist:
+        return JsonResponse({'detail': 'No Payment matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+
+    if payment.payment_state == "COMPLETED":
+        return JsonResponse({"detail": "Payment has already been verified."}, status=status.HTTP_200_OK)
+
+    async with AsyncZarrinPal() as zarrinpal:
+        zarrinpal_response = await zarrinpal.verify_payment(
+            authority=payment.authority,
+            amount=payment.total_price
+        )
+    payment = await sync_to_async(record_verification)(payment, zarrinpal_response)
+    data, status_code = verification_response(payment, zarrinpal_response)
+    return JsonResponse(data, status=status_code)
@@ -0,0 +1,34 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+CATALOG_VERSION_KEY = 'catalog-version'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """Invalidate every catalog ETag once the current transaction commits."""
+    transaction.on_commit(lambda: cache.set(CATALOG_VERSION_KEY, time.time(), timeout=None))
+
+
+def catalog_etag(request, *args, **kwargs):
+    return f'catalog-{get_catalog_version()}'
+
+
+# Answers If-None-Match with 304 before the view runs, and makes clients revalidate. No Last-Modified: it only
+# has whole seconds, so a client could be told a catalog changed twice in one second wasn't modified.
+# Apply with method_decorator().
+catalog_condition = [
+    cache_control(no_cache=True),
+    condition(etag_func=catalog_etag),
+]
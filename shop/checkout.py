@@ -0,0 +1,340 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from accounts.models import Accessory, User
+from .models import Participation, Payment, Coupon, PaymentInitiation, hold_expiry
+from .payments import ZarrinPal
+
+COMPETITION_PRICE = 50_000
+COMPETITION_CAPACITY = 50
+
+
+class CheckoutError(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+
+    def __init__(self, detail, errors=None):
+        data = {'detail': detail}
+        if errors:
+            data['errors'] = errors
+        super().__init__(data)
+
+
+def reserve_checkout(user, coupon_code=None, accessory_ids=()):
+    """
+    Phase one of checkout: validate the user's cart and record a pending payment together with its
+    initiation outbox record, in one short transaction. Free carts are completed right away and
+    return None. Raises CheckoutError if the cart can't be paid.
+    """
+    with transaction.atomic():
+        # Lock the participations only; their presentations are fetched with one unlocked IN query.
+        participations = Participation.objects.select_for_update().filter(
+            user=user, payment_state="PENDING"
+        ).prefetch_related('presentation')
+        if not participations:
+            raise CheckoutError("No pending participations found.")
+
+        now = timezone.now()
+        errors = []
+        for participation in participations:
+            presentation = participation.presentation
+            if presentation.start <= now:
+                errors.append(f'Presentation {presentation.en_title} has already started.')
+            elif not presentation.is_registration_active:
+                errors.append(f'Registration is closed for presentation {presentation.en_title}.')
+            elif presentation.sold_count >= presentation.capacity:
+                errors.append(f'No remaining capacity for presentation {presentation.en_title}.')
+
+        if errors:
+            raise CheckoutError(errors[0], errors)
+
+        # Keep the seats held while the user is on the gateway, including holds expired but not yet swept.
+        Participation.objects.filter(id__in=[p.id for p in participations]).update(
+            held_until=hold_expiry(settings.SEAT_HOLD_CHECKOUT_SECONDS)
+        )
+
+        total_price = sum(p.presentation.cost for p in participations)
+        accessories = Accessory.objects.filter(id__in=accessory_ids)
+        # TODO: Check for inactive accessories and return if any isn't active
+
+        if total_price == 0:
+            for accessory in accessories.all():
+                user.accessories.add(accessory)
+            participations.complete()
+            return None
+
+        total_price += sum(accessory.price for accessory in accessories)
+
+        coupon = None
+        if coupon_code:
+            # Not locked: the coupon is only redeemed, with a conditional decrement, once the payment is verified.
+            coupon = Coupon.objects.filter(name=coupon_code, count__gt=0).first()
+            if not coupon:
+                raise CheckoutError("کد تخفیف نامعتبر!")
+            discount = (coupon.percentage / 100) * total_price
+            total_price -= discount
+
+        # A retry after the gateway was unreachable carries on with the payment it already made.
+        participation_ids = {p.id for p in participations}
+        accessory_ids = set(accessories.values_list('id', flat=True))
+        reusable = reusable_payments(user).filter(is_competition_payment=False, coupon=coupon).prefetch_related(
+            'participations', 'accessories'
+        )
+        for payment in reusable:
+            if ({p.id for p in payment.participations.all()} == participation_ids
+                    and {a.id for a in payment.accessories.all()} == accessory_ids):
+                return payment
+
+        payment = Payment.objects.create(
+            user=user,
+            total_price=total_price,
+            coupon=coupon,
+        )
+        payment.participations.set(participations)
+        payment.accessories.set(accessories)
+        PaymentInitiation.objects.create(payment=payment)
+
+    return payment
+
+
+def reserve_competition_checkout(user):
+    """Phase one of the competition signup: record a pending competition payment and its initiation."""
+    if user.is_signed_up_for_competition:
+        raise CheckoutError("شما برای مسابقه قبلا ثبت نام کردید!")
+
+    # TODO: Move this shit to db
+    if User.objects.filter(is_signed_up_for_competition=True).count() >= COMPETITION_CAPACITY:
+        raise CheckoutError("ظرفیت مسابقه پر شده است!")
+
+    with transaction.atomic():
+        payment = reusable_payments(user).filter(is_competition_payment=True).first()
+        if payment:
+            return payment
+        payment = Payment.objects.create(
+            user=user,
+            total_price=COMPETITION_PRICE,
+            is_competition_payment=True
+        )
+        PaymentInitiation.objects.create(payment=payment)
+    return payment
+
+
+def reusable_payments(user):
+    """
+    The user's pending payments a new checkout can carry on with instead of creating another: the ones that
+    haven't reached the gateway yet, and the ones that got a pay link that is still within the checkout hold.
+    """
+    sent_since = timezone.now() - timedelta(seconds=settings.SEAT_HOLD_CHECKOUT_SECONDS)
+    return Payment.objects.filter(user=user, payment_state="PENDING").filter(
+        Q(initiation__state="PENDING") | Q(initiation__state="SENT", initiation__updated_date__gte=sent_since)
+    ).select_related('user').order_by('-created_date')
+
+
+def initiated_response(payment):
+    """The gateway response of a payment that already has its authority."""
+    return {'status': 'success', 'authority': payment.authority, 'error': None, 'link': payment.pay_link}
+
+
+def initiate_payment(payment, zarrinpal=None):
+    """
+    Phase two of checkout: ask the gateway for an authority, outside of any transaction, and record the
+    outcome on the payment and its initiation. Returns the gateway response.
+    """
+    if payment.pay_link:
+        return initiated_response(payment)
+    zarrinpal = zarrinpal or ZarrinPal()
+    zarrinpal_response = zarrinpal.create_payment(
+        amount=payment.total_price,
+        mobile=payment.user.phone_number,
+        email=payment.user.email
+    )
+    return record_initiation(payment, zarrinpal_response)
+
+
+def record_initiation(payment, zarrinpal_response):
+    with transaction.atomic():
+        initiation = PaymentInitiation.objects.select_for_update().get(payment=payment)
+        if initiation.state == "SENT":
+            # Initiated by a retry in the meantime, hand out its pay link.
+            payment.refresh_from_db(fields=['authority', 'pay_link'])
+            return initiated_response(payment)
+        if initiation.state != "PENDING":
+            # Expired or already initiated by someone else while we were waiting on the gateway.
+            return {'status': 'failed', 'authority': None, 'error': 'Payment initiation expired.', 'link': None}
+
+        initiation.attempts += 1
+        if zarrinpal_response['status'] == 'success':
+            payment.authority = zarrinpal_response['authority']
+            payment.pay_link = zarrinpal_response['link']
+            payment.save(update_fields=['authority', 'pay_link'])
+            initiation.state = "SENT"
+        elif zarrinpal_response['status'] == 'error':
+            # The gateway wasn't reached, or didn't answer. Left pending, for the user to try again with the
+            # same payment, or for process_payment_initiations.
+            initiation.last_error = zarrinpal_response.get('error') or ''
+        else:
+            payment.payment_state = "FAILED"
+            payment.save(update_fields=['payment_state'])
+            initiation.state = "FAILED"
+            initiation.last_error = zarrinpal_response.get('error') or ''
+        initiation.save()
+
+    return zarrinpal_response
+
+
+def initiation_response(payment, zarrinpal_response):
+    """Response data and status code of a checkout endpoint."""
+    if zarrinpal_response['status'] == 'success':
+        return {
+            "payment_url": zarrinpal_response['link'],
+            "authority": zarrinpal_response['authority']
+        }, status.HTTP_200_OK
+    elif zarrinpal_response['status'] == 'error':
+        return {
+            "detail": "Payment gateway is unavailable, please try again.",
+            "error": zarrinpal_response.get('error')
+        }, status.HTTP_503_SERVICE_UNAVAILABLE
+    else:
+        return {
+            "detail": "Payment initiation failed.",
+            "error": zarrinpal_response.get('error')
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def verify_payment(payment, zarrinpal=None):
+    """Verify a payment with the gateway, without holding any lock, and record the outcome."""
+    zarrinpal = zarrinpal or ZarrinPal()
+    zarrinpal_response = zarrinpal.verify_payment(
+        authority=payment.authority,
+        amount=payment.total_price
+    )
+    return record_verification(payment, zarrinpal_response), zarrinpal_response
+
+
+def record_verification(payment, zarrinpal_response):
+    """
+    Complete or fail a payment from the gateway's verification in one short transaction, and return it.
+    A payment completed by a concurrent verification is left as is, and an unreachable gateway leaves
+    the payment pending.
+    """
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().select_related('user').get(pk=payment.pk)
+        payment.unseated = []
+        if payment.payment_state == "COMPLETED":
+            return payment
+
+        if zarrinpal_response['status'] == 'success':
+            payment.ref_id = zarrinpal_response['ref_id']
+            payment.card_pan = zarrinpal_response['card_pan']
+            payment.payment_state = "COMPLETED"
+            payment.verified_date = timezone.now()
+            payment.save()
+
+            if payment.is_competition_payment:
+                payment.user.is_signed_up_for_competition = True
+                payment.user.save()
+            else:
+                payment.participations.complete()
+                payment.unseated = list(
+                    payment.participations.paid_without_seat().values_list('presentation__en_title', flat=True)
+                )
+                # Already paid with the discount, so a coupon used up in the meantime is let through.
+                if payment.coupon_id:
+                    Coupon.redeem(payment.coupon_id)
+
+                for accessory in payment.accessories.all():
+                    payment.user.accessories.add(accessory)
+        elif zarrinpal_response['status'] == 'failed':
+            payment.payment_state = "FAILED"
+            payment.save()
+
+    return payment
+
+
+def record_verifications(payments, zarrinpal_responses):
+    """
+    Bulk variant of record_verification, used to reconcile stale payments: completes or fails the payments
+    that are still pending with a fixed number of queries, whatever the number of payments. Returns a Counter
+    of the outcomes, with the participations of completed payments whose seat was given away as `unseated`.
+    """
+    responses = {payment.pk: response for payment, response in zip(payments, zarrinpal_responses)}
+    outcomes = Counter()
+    with transaction.atomic():
+        locked = Payment.objects.select_for_update().filter(pk__in=responses, payment_state="PENDING")
+        completed, failed = [], []
+        now = timezone.now()
+        for payment in locked:
+            response = responses[payment.pk]
+            if response['status'] == 'success':
+                payment.ref_id = response['ref_id']
+                payment.card_pan = response['card_pan']
+                payment.payment_state = "COMPLETED"
+                payment.verified_date = now
+                completed.append(payment)
+            elif response['status'] == 'failed':
+                failed.append(payment.pk)
+        outcomes.update(completed=len(completed), failed=len(failed))
+        outcomes['skipped'] = len(responses) - len(completed) - len(failed)
+
+        Payment.objects.bulk_update(completed, ['ref_id', 'card_pan', 'payment_state', 'verified_date'])
+        Payment.objects.filter(pk__in=failed).update(payment_state="FAILED")
+
+        User.objects.filter(
+            pk__in=[payment.user_id for payment in completed if payment.is_competition_payment]
+        ).update(is_signed_up_for_competition=True)
+
+        payment_ids = [payment.pk for payment in completed if not payment.is_competition_payment]
+        participations = Participation.objects.filter(
+            id__in=Payment.participations.through.objects.filter(payment_id__in=payment_ids).values('participation_id')
+        )
+        participations.complete()
+        outcomes['unseated'] = participations.paid_without_seat().count()
+
+        coupon_uses = Counter(payment.coupon_id for payment in completed
+                              if payment.coupon_id and not payment.is_competition_payment)
+        for coupon_id, uses in coupon_uses.items():
+            if not Coupon.redeem(coupon_id, uses):
+                Coupon.objects.filter(pk=coupon_id).update(count=0)
+
+        users = {payment.pk: payment.user_id for payment in completed}
+        User.accessories.through.objects.bulk_create([
+            User.accessories.through(user_id=users[payment_id], accessory_id=accessory_id)
+            for payment_id, accessory_id in Payment.accessories.through.objects.filter(
+                payment_id__in=payment_ids
+            ).values_list('payment_id', 'accessory_id')
+        ], ignore_conflicts=True)
+
+    return outcomes
+
+
+def verification_response(payment, zarrinpal_response):
+    """Response data and status code of a verify endpoint."""
+    if payment.payment_state == "COMPLETED":
+        data = {
+            "detail": "Payment verified successfully.",
+            "ref_id": payment.ref_id,
+            "card_pan": payment.card_pan,
+            "amount": payment.total_price,
+        }
+        if getattr(payment, 'unseated', None):
+            # Paid after the hold expired and the seat went to someone else.
+            data["detail"] = "Payment verified, but some presentations filled up meanwhile and will be refunded."
+            data["unseated"] = payment.unseated
+        return data, status.HTTP_200_OK
+    elif zarrinpal_response['status'] == 'unexpected':
+        # The gateway could not be reached, the payment may still succeed so it is kept pending.
+        return {
+            "detail": "Payment gateway is unavailable, try again later.",
+            "error": zarrinpal_response.get('error')
+        }, status.HTTP_503_SERVICE_UNAVAILABLE
+    else:
+        return {
+            "detail": "Payment verification failed.",
+            "error": zarrinpal_response.get('error')
+        }, status.HTTP_400_BAD_REQUEST
@@ -0,0 +1,62 @@
+import csv
+import json
+
+from .models import Participation
+
+REGISTRATION_FIELDS = ['presentation', 'phone_number', 'first_name', 'last_name', 'email']
+
+
+def write_coupons(file, coupons):
+    """Write coupons as CSV, one code per row, for sponsors to hand out."""
+    writer = csv.writer(file)
+    writer.writerow(['code', 'percentage', 'uses'])
+    writer.writerows((coupon.name, coupon.percentage, coupon.count) for coupon in coupons)
+
+
+class Echo:
+    """A file-like object for csv.writer that hands back each line instead of keeping it."""
+
+    def write(self, value):
+        return value
+
+
+def registration_rows(presentations, chunk_size=2000):
+    """
+    Yield the completed registrations of `presentations` as dicts of REGISTRATION_FIELDS. Read in keyset
+    paginated chunks of `chunk_size`, so memory stays flat however many rows there are, even with database
+    drivers that buffer a whole result set.
+    """
+    for presentation_id, title in presentations.order_by('id').values_list('id', 'en_title'):
+        registrations = Participation.objects.filter(
+            presentation_id=presentation_id, payment_state="COMPLETED"
+        ).order_by('id')
+        last_id = 0
+        while True:
+            chunk = registrations.filter(id__gt=last_id).values(
+                'id', 'user__phone_number', 'user__first_name', 'user__last_name', 'user__email'
+            )[:chunk_size]
+            count = 0
+            for row in chunk.iterator(chunk_size=chunk_size):
+                count += 1
+                last_id = row['id']
+                yield {
+                    'presentation': title,
+                    'phone_number': row['user__phone_number'],
+                    'first_name': row['user__first_name'],
+                    'last_name': row['user__last_name'],
+                    'email': row['user__email'],
+                }
+            if count < chunk_size:
+                break
+
+
+def stream_csv(rows, fields):
+    writer = csv.DictWriter(Echo(), fields)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
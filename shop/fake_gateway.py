@@ -0,0 +1,260 @@
+"""
+A local stand-in for the ZarrinPal gateway, to test and load test checkout without real payments. It serves
+request.json, verify.json and StartPay over HTTP, either in-process on a background thread:
+
+    with FakeGateway(latency=lognormal(0.2, 0.5)) as gateway:
+        ...  # point ZarrinPal at gateway.url
+
+or standalone with `manage.py run_fake_gateway`, with PAYMENT_GATEWAY_URL set to its address.
+"""
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+from .payments import ZarrinPal
+
+REQUEST_PATH = '/pg/v4/payment/request.json'
+VERIFY_PATH = '/pg/v4/payment/verify.json'
+START_PAY_PATH = '/pg/StartPay/'
+
+STATUS_AMOUNT_MISMATCH = 50
+
+MESSAGES = {
+    ZarrinPal.STATUS_SUCCESS: 'Success',
+    ZarrinPal.STATUS_VERIFIED: 'Verified',
+    ZarrinPal.STATUS_NOT_VALID: 'The input params invalid, validation error.',
+    ZarrinPal.STATUS_API_KEY_ERROR: 'Terminal is not valid, please check merchant_id or ip address.',
+    STATUS_AMOUNT_MISMATCH: 'Session is not valid, amounts values is not the same.',
+    ZarrinPal.STATUS_FAILED: 'Session is not valid, session is not active paid try.',
+}
+
+# Faults that can be injected besides the error codes: a request that never gets an answer in time, and
+# a gateway that is down.
+TIMEOUT = 'timeout'
+SERVER_ERROR = 'server_error'
+
+
+def fixed(seconds):
+    return lambda: seconds
+
+
+def uniform(low, high):
+    return lambda: random.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """Mostly around `median` with a long tail, like the latency of a real gateway."""
+    return lambda: random.lognormvariate(math.log(median), sigma)
+
+
+LATENCIES = {'fixed': fixed, 'uniform': uniform, 'lognormal': lognormal}
+
+
+def parse_latency(spec):
+    """Parse a latency distribution like `0.2`, `uniform:0.1,0.5` or `lognormal:0.2,0.5`, in seconds."""
+    name, _, params = spec.rpartition(':')
+    try:
+        return LATENCIES[name or 'fixed'](*(float(param) for param in params.split(',')))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f'Invalid latency {spec!r}, expected one of {", ".join(LATENCIES)} with its parameters.')
+
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            data = {}
+        delay, status_code, body = self.server.gateway.respond(self.path, data)
+        time.sleep(delay)
+        self.send(status_code, json.dumps(body).encode(), 'application/json')
+
+    def do_GET(self):
+        if not self.path.startswith(START_PAY_PATH):
+            return self.send(404, b'Not found', 'text/plain')
+
+        authority = self.path[len(START_PAY_PATH):]
+        callback_url = self.server.gateway.pay(authority)
+        if callback_url is None:
+            return self.send(404, b'Unknown authority', 'text/plain')
+        self.send_response(302)
+        self.send_header('Location', f'{callback_url}?{urlencode({"Authority": authority, "Status": "OK"})}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send(self, status_code, content, content_type):
+        try:
+            self.send_response(status_code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        except ConnectionError:
+            pass  # The client gave up waiting.
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGatewayServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeGateway:
+    """
+    Answers like ZarrinPal after a delay drawn from `latency`. Requests fail at random with the error
+    codes of `error_rates` ({code: probability}), and with TIMEOUT or SERVER_ERROR at `timeout_rate` and
+    `server_error_rate`. A timed out request is answered after `hang` seconds. Faults can also be queued
+    with fail_next(), or pinned to an authority with issue().
+
+    Authorities are paid as soon as they are issued, unless `auto_pay` is off. Then they are only paid
+    once their StartPay link is visited, which redirects to the callback url like the real gateway.
+    """
+
+    def __init__(self, latency=None, error_rates=None, timeout_rate=0, server_error_rate=0, hang=30,
+                 auto_pay=True):
+        self.latency = latency or fixed(0)
+        self.error_rates = error_rates or {}
+        self.timeout_rate = timeout_rate
+        self.server_error_rate = server_error_rate
+        self.hang = hang
+        self.auto_pay = auto_pay
+
+        self.transactions = {}
+        self.faults = []
+        self.requests = []
+        self.last_ref_id = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = FakeGatewayServer((host, port), FakeGatewayHandler)
+        self.server.gateway = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def issue(self, amount, paid=None, fault=None, callback_url=''):
+        """Issue an authority for `amount` rials, as if requested by a checkout. Returns the authority."""
+        authority = f'A{uuid.uuid4().int % 10 ** 35:035d}'
+        with self.lock:
+            self.transactions[authority] = {
+                'amount': amount,
+                'paid': self.auto_pay if paid is None else paid,
+                'ref_id': None,
+                'fault': fault,
+                'callback_url': callback_url,
+            }
+        return authority
+
+    def fail_next(self, *faults):
+        """Fail the next requests, in order, with these error codes, TIMEOUT or SERVER_ERROR."""
+        with self.lock:
+            self.faults.extend(faults)
+
+    def pay(self, authority):
+        with self.lock:
+            transaction = self.transactions.get(authority)
+            if transaction is None:
+                return None
+            transaction['paid'] = True
+            return transaction['callback_url']
+
+    def respond(self, path, data):
+        """The delay, status code and body of the answer to a gateway request."""
+        self.requests.append(path)
+        delay = self.latency()
+
+        fault = self.next_fault(path, data)
+        if fault == TIMEOUT:
+            return self.hang, 504, {}
+        if fault == SERVER_ERROR:
+            return delay, 502, {}
+        if fault == ZarrinPal.STATUS_VERIFIED and path == VERIFY_PATH:
+            return delay, 200, self.verified(data, replayed=True)
+        if fault is not None:
+            return delay, 200, self.error(fault)
+
+        if path == REQUEST_PATH:
+            return delay, 200, self.request_payment(data)
+        if path == VERIFY_PATH:
+            return delay, 200, self.verify(data)
+        return delay, 404, {}
+
+    def next_fault(self, path, data):
+        with self.lock:
+            if self.faults:
+                return self.faults.pop(0)
+            transaction = self.transactions.get(data.get('authority'))
+            if transaction and transaction['fault'] is not None:
+                return transaction['fault']
+
+        draw = random.random()
+        for fault, rate in [(TIMEOUT, self.timeout_rate), (SERVER_ERROR, self.server_error_rate),
+                            *self.error_rates.items()]:
+            if path == REQUEST_PATH and fault in (ZarrinPal.STATUS_FAILED, ZarrinPal.STATUS_VERIFIED):
+                continue  # Only a verification can find a payment failed or already verified.
+            if draw < rate:
+                return fault
+            draw -= rate
+        return None
+
+    @staticmethod
+    def error(code):
+        return {'data': [], 'errors': {'code': -code, 'message': MESSAGES.get(code, 'Unknown error.'),
+                                       'validations': []}}
+
+    def request_payment(self, data):
+        if not data.get('merchant_id'):
+            return self.error(ZarrinPal.STATUS_API_KEY_ERROR)
+        if not isinstance(data.get('amount'), (int, float)) or data['amount'] <= 0 or not data.get('callback_url'):
+            return self.error(ZarrinPal.STATUS_NOT_VALID)
+
+        authority = self.issue(data['amount'], callback_url=data['callback_url'])
+        return {'data': {'code': ZarrinPal.STATUS_SUCCESS, 'message': MESSAGES[ZarrinPal.STATUS_SUCCESS],
+                         'authority': authority, 'fee_type': 'Merchant', 'fee': 0}, 'errors': []}
+
+    def verify(self, data):
+        with self.lock:
+            transaction = self.transactions.get(data.get('authority'))
+            if transaction is None:
+                return self.error(ZarrinPal.STATUS_NOT_VALID)
+            if transaction['amount'] != data.get('amount'):
+                return self.error(STATUS_AMOUNT_MISMATCH)
+            if not transaction['paid']:
+                return self.error(ZarrinPal.STATUS_FAILED)
+        return self.verified(data, replayed=False)
+
+    def verified(self, data, replayed):
+        with self.lock:
+            transaction = self.transactions.get(data.get('authority'), {'ref_id': None})
+            if transaction['ref_id'] is None:
+                self.last_ref_id += 1
+                transaction['ref_id'] = self.last_ref_id
+            elif not replayed:
+                replayed = True  # Verified before, the real gateway answers with 101 from then on.
+
+        code = ZarrinPal.STATUS_VERIFIED if replayed else ZarrinPal.STATUS_SUCCESS
+        return {'data': {'code': code, 'message': MESSAGES[code], 'card_hash': '', 'card_pan': '502229******5995',
+                         'ref_id': transaction['ref_id'], 'fee_type': 'Merchant', 'fee': 0}, 'errors': []}
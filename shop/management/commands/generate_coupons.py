@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.exports import write_coupons
+from shop.models import Coupon
+
+
+class Command(BaseCommand):
+    help = 'Generate single-use coupons with unique random codes, and write them as CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='Number of coupons to generate.')
+        parser.add_argument('--prefix', default='', help='Prefix of the codes, e.g. the sponsor name.')
+        parser.add_argument('--percentage', type=int, required=True, help='Discount percentage.')
+        parser.add_argument('--uses', type=int, default=1, help='Times each code can be used.')
+        parser.add_argument('--length', type=int, default=8, help='Random characters after the prefix.')
+        parser.add_argument('--output', help='CSV file to write the codes to, instead of the standard output.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            coupons = Coupon.objects.generate(
+                options['count'],
+                prefix=options['prefix'],
+                percentage=options['percentage'],
+                uses=options['uses'],
+                length=options['length'],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as file:
+                write_coupons(file, coupons)
+        else:
+            write_coupons(self.stdout, coupons)
+
+        self.stderr.write(self.style.SUCCESS(
+            f'Generated {len(coupons)} coupon(s) in {time.monotonic() - started:.1f}s.'
+        ))
@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections, transaction
+from django.utils import timezone
+
+from shop.checkout import initiate_payment
+from shop.models import PaymentInitiation, Payment
+
+
+class Command(BaseCommand):
+    help = ('Retry payment initiations left pending by an interrupted checkout, '
+            'and expire the ones that are too old to be useful.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-after', type=int, default=120,
+                            help='Seconds before a pending initiation is considered stuck, doubled after every '
+                                 'retry that fails to reach the gateway.')
+        parser.add_argument('--expire-after', type=int, default=15 * 60,
+                            help='Seconds before a pending initiation is expired instead of retried.')
+        parser.add_argument('--max-attempts', type=int, default=3,
+                            help='Attempts before a pending initiation is expired.')
+        parser.add_argument('--loop', action='store_true', help='Keep processing, instead of running once and exiting.')
+        parser.add_argument('--interval', type=float, default=30, help='Seconds between runs with --loop.')
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            self.process(options)
+            return
+
+        while True:
+            try:
+                self.process(options)
+            except (OperationalError, InterfaceError) as e:
+                self.stderr.write(f'Database error, retrying in {options["interval"]} s: {e}')
+            close_old_connections()
+            time.sleep(options['interval'])
+
+    def process(self, options):
+        now = timezone.now()
+        pending = PaymentInitiation.objects.filter(state="PENDING")
+
+        expired = self.expire(
+            pending.filter(created_date__lt=now - timedelta(seconds=options['expire_after']))
+            | pending.filter(attempts__gte=options['max_attempts'])
+        )
+
+        retried = 0
+        stuck = pending.filter(
+            created_date__lt=now - timedelta(seconds=options['retry_after']), next_attempt__lte=now
+        ).select_related('payment__user')
+        for initiation in stuck.iterator():
+            response = initiate_payment(initiation.payment)
+            retried += 1
+            if response['status'] == 'error':
+                backoff = options['retry_after'] * 2 ** initiation.attempts
+                PaymentInitiation.objects.filter(pk=initiation.pk, state="PENDING").update(
+                    next_attempt=timezone.now() + timedelta(seconds=backoff)
+                )
+            self.stdout.write(f'{initiation.payment}: {response["status"]} {response.get("error") or ""}'.rstrip())
+
+        if expired or retried or not options['loop']:
+            self.stdout.write(self.style.SUCCESS(f'Expired {expired} and retried {retried} payment initiation(s).'))
+
+    @staticmethod
+    def expire(initiations):
+        with transaction.atomic():
+            payment_ids = list(initiations.select_for_update().values_list('payment_id', flat=True))
+            PaymentInitiation.objects.filter(payment_id__in=payment_ids).update(
+                state="EXPIRED", updated_date=timezone.now()
+            )
+            Payment.objects.filter(id__in=payment_ids, payment_state="PENDING").update(payment_state="FAILED")
+        return len(payment_ids)
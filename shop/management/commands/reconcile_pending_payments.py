@@ -0,0 +1,76 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from shop.checkout import record_verifications
+from shop.models import Payment
+from shop.payments import ZarrinPal, CircuitBreaker, build_session
+
+
+class Command(BaseCommand):
+    help = ('Verify payments left pending by users who never came back from the gateway, '
+            'and complete or fail them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=30 * 60,
+                            help='Seconds before a pending payment is considered abandoned.')
+        parser.add_argument('--chunk-size', type=int, default=200,
+                            help='Payments verified and updated per chunk.')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Concurrent gateway requests.')
+
+    def handle(self, *args, **options):
+        stale = Payment.objects.filter(
+            payment_state="PENDING",
+            authority__isnull=False,
+            created_date__lt=timezone.now() - timedelta(seconds=options['older_than']),
+        ).only('id', 'authority', 'total_price', 'created_date').order_by('created_date', 'id')
+
+        # A batch of its own: a struggling gateway shouldn't open the circuit for the web workers.
+        zarrinpal = ZarrinPal(session=build_session(pool_maxsize=options['workers']), circuit_breaker=CircuitBreaker())
+
+        outcomes = Counter()
+        checked = 0
+        started = time.monotonic()
+        last = None
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                chunk = stale
+                if last is not None:
+                    # Keyset pagination, payments the gateway couldn't answer for stay pending behind us.
+                    chunk = chunk.filter(
+                        Q(created_date__gt=last.created_date) | Q(created_date=last.created_date, id__gt=last.id)
+                    )
+                chunk = list(chunk[:options['chunk_size']])
+                if not chunk:
+                    break
+
+                responses = executor.map(
+                    lambda payment: zarrinpal.verify_payment(authority=payment.authority, amount=payment.total_price),
+                    chunk
+                )
+                outcomes.update(record_verifications(chunk, list(responses)))
+                checked += len(chunk)
+                last = chunk[-1]
+
+                self.stdout.write(
+                    f'Checked {checked} payment(s), {checked / (time.monotonic() - started):.1f}/s: '
+                    f'{outcomes["completed"]} completed, {outcomes["failed"]} failed, {outcomes["skipped"]} skipped.'
+                )
+                if zarrinpal.circuit_breaker.opened_at is not None:
+                    self.stderr.write('Payment gateway is unavailable, stopping.')
+                    break
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Completed {outcomes["completed"]} and failed {outcomes["failed"]} of {checked} stale payment(s).'
+        ))
+        if outcomes['unseated']:
+            self.stderr.write(
+                f'{outcomes["unseated"]} paid participation(s) lost their seat while pending, '
+                f'refund them: Participation.objects.paid_without_seat().'
+            )
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shop.models import Presentation, Participation
+
+
+class Command(BaseCommand):
+    help = 'Recompute the reserved and sold seat counters of presentations from their participations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report drifted counters.')
+
+    def handle(self, *args, **options):
+        drifted = 0
+        for presentation_id in Presentation.objects.values_list('id', flat=True).iterator():
+            # Lock the presentation so no counter update can slip in between counting and writing.
+            with transaction.atomic():
+                presentation = Presentation.objects.select_for_update().get(id=presentation_id)
+                participations = Participation.objects.filter(presentation=presentation)
+                reserved = participations.filter(payment_state="PENDING").count()
+                sold = participations.filter(payment_state="COMPLETED").count()
+
+                if presentation.reserved_count == reserved and presentation.sold_count == sold:
+                    continue
+
+                drifted += 1
+                self.stdout.write(
+                    f'{presentation}: reserved {presentation.reserved_count} -> {reserved}, '
+                    f'sold {presentation.sold_count} -> {sold}'
+                )
+                if not options['dry_run']:
+                    Presentation.objects.filter(pk=presentation.pk).update(reserved_count=reserved, sold_count=sold)
+
+        action = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f'{action} {drifted} drifted presentation(s).'))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from shop.models import Presentation, Participation
+
+
+class Command(BaseCommand):
+    help = 'Fail pending participations whose seat hold has expired, and give their seats back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Holds released per transaction.')
+        parser.add_argument('--loop', action='store_true', help='Keep sweeping, instead of sweeping once and exiting.')
+        parser.add_argument('--interval', type=float, default=30, help='Seconds between sweeps with --loop.')
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            self.stdout.write(self.style.SUCCESS(f'Released {self.sweep(options["chunk_size"])} expired seat hold(s).'))
+            return
+
+        while True:
+            try:
+                released = self.sweep(options['chunk_size'])
+            except (OperationalError, InterfaceError) as e:
+                self.stderr.write(f'Database error, retrying in {options["interval"]} s: {e}')
+            else:
+                if released:
+                    self.stdout.write(self.style.SUCCESS(f'Released {released} expired seat hold(s).'))
+            close_old_connections()
+            time.sleep(options['interval'])
+
+    def sweep(self, chunk_size):
+        released = 0
+        # One presentation at a time, so every chunk is read from the (presentation, payment_state, held_until)
+        # index and only that presentation's row is locked while its counter is updated.
+        for presentation_id in Presentation.objects.filter(reserved_count__gt=0).values_list('id', flat=True):
+            count = Participation.objects.filter(presentation_id=presentation_id).release_expired(
+                chunk_size=chunk_size
+            )
+            if count:
+                self.stdout.write(f'Presentation {presentation_id}: released {count} seat hold(s).')
+            released += count
+        return released
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.fake_gateway import FakeGateway, parse_latency
+
+
+def error_rate(value):
+    code, _, rate = value.partition('=')
+    return int(code), float(rate)
+
+
+class Command(BaseCommand):
+    help = ('Serve a fake ZarrinPal gateway for local load tests. '
+            'Point PAYMENT_GATEWAY_URL at it before starting the backend.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8200)
+        parser.add_argument('--latency', default='0',
+                            help='Latency in seconds, e.g. 0.2, uniform:0.1,0.5 or lognormal:0.2,0.5.')
+        parser.add_argument('--error-rate', type=error_rate, action='append', default=[], metavar='CODE=RATE',
+                            help='Answer with error code 9, 10, 51 or 101 at this rate, can be repeated.')
+        parser.add_argument('--timeout-rate', type=float, default=0,
+                            help='Rate of requests answered only after --hang seconds.')
+        parser.add_argument('--server-error-rate', type=float, default=0,
+                            help='Rate of requests answered with a 502.')
+        parser.add_argument('--hang', type=float, default=30)
+        parser.add_argument('--no-auto-pay', action='store_true',
+                            help='Only pay authorities once their StartPay link is visited.')
+
+    def handle(self, *args, **options):
+        try:
+            latency = parse_latency(options['latency'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        gateway = FakeGateway(
+            latency=latency,
+            error_rates=dict(options['error_rate']),
+            timeout_rate=options['timeout_rate'],
+            server_error_rate=options['server_error_rate'],
+            hang=options['hang'],
+            auto_pay=not options['no_auto_pay'],
+        )
+        gateway.start(options['host'], options['port'])
+        self.stdout.write(self.style.SUCCESS(f'Fake ZarrinPal gateway listening on {gateway.url}'))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            gateway.stop()
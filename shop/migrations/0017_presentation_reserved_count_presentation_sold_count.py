@@ -0,0 +1,37 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:34
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def populate_seat_counters(apps, schema_editor):
+    Presentation = apps.get_model('shop', 'Presentation')
+    presentations = Presentation.objects.annotate(
+        pending=Count('participations', filter=Q(participations__payment_state='PENDING')),
+        completed=Count('participations', filter=Q(participations__payment_state='COMPLETED')),
+    )
+    for presentation in presentations:
+        Presentation.objects.filter(pk=presentation.pk).update(
+            reserved_count=presentation.pending, sold_count=presentation.completed
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0016_payment_is_competition_payment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='presentation',
+            name='reserved_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='presentation',
+            name='sold_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_seat_counters, migrations.RunPython.noop),
+    ]
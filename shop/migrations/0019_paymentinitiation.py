@@ -0,0 +1,29 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0018_payment_payment_user_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentInitiation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('PENDING', 'PENDING'), ('SENT', 'SENT'), ('FAILED', 'FAILED'), ('EXPIRED', 'EXPIRED')], default='PENDING', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='initiation', to='shop.payment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'created_date'], name='initiation_state_created_idx')],
+            },
+        ),
+    ]
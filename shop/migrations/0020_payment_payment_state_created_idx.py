@@ -0,0 +1,20 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_user_is_signed_up_for_competition'),
+        ('shop', '0019_paymentinitiation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payment_state', 'created_date'], name='payment_state_created_idx'),
+        ),
+    ]
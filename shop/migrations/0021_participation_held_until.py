@@ -0,0 +1,36 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:50
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def hold_pending_participations(apps, schema_editor):
+    # Carts from before seat holds get one hold period from now, instead of holding their seats forever.
+    Participation = apps.get_model('shop', 'Participation')
+    Participation.objects.filter(payment_state='PENDING').update(
+        held_until=timezone.now() + timedelta(seconds=settings.SEAT_HOLD_SECONDS)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0020_payment_payment_state_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participation',
+            name='held_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='participation',
+            index=models.Index(fields=['presentation', 'payment_state', 'held_until'], name='participation_hold_idx'),
+        ),
+        migrations.RunPython(hold_pending_participations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_user_is_signed_up_for_competition'),
+        ('shop', '0021_participation_held_until'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='authority',
+            field=models.CharField(max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='participation',
+            index=models.Index(fields=['user', 'payment_state'], name='participation_user_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='participation',
+            index=models.Index(fields=['user', 'presentation'], name='participation_user_pres_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['coupon', 'payment_state'], name='payment_coupon_state_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:52
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_participations(apps, schema_editor):
+    # Keep one participation per (user, presentation), a completed one if there is any. Run
+    # `manage.py reconcile_seat_counters` afterwards if anything was deleted.
+    Participation = apps.get_model('shop', 'Participation')
+    duplicates = Participation.objects.values('user', 'presentation').annotate(
+        count=Count('id'), first=Min('id')
+    ).filter(count__gt=1)
+    for duplicate in duplicates:
+        participations = Participation.objects.filter(user=duplicate['user'], presentation=duplicate['presentation'])
+        kept = participations.filter(payment_state='COMPLETED').order_by('id').first() or \
+            participations.get(id=duplicate['first'])
+        participations.exclude(id=kept.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0022_hot_lookup_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_participations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='participation',
+            constraint=models.UniqueConstraint(fields=('user', 'presentation'), name='participation_user_presentation_unique'),
+        ),
+        migrations.RemoveIndex(
+            model_name='participation',
+            name='participation_user_pres_idx',
+        ),
+    ]
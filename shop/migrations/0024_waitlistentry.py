@@ -0,0 +1,30 @@
+# Generated by Django 5.1.5 on 2026-10-18 16:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0023_participation_user_presentation_unique'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('presentation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to='shop.presentation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'waitlist entries',
+                'indexes': [models.Index(fields=['presentation', 'created_date'], name='waitlist_presentation_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'presentation'), name='waitlist_user_presentation_unique')],
+            },
+        ),
+    ]
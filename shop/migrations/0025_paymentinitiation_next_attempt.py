@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:25
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0024_waitlistentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentinitiation',
+            name='next_attempt',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
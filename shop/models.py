@@ -1,10 +1,19 @@
+import secrets
+from collections import Counter
+from datetime import timedelta
+
 from colorfield.fields import ColorField
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Length
 from django.conf import settings
+from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 from tinymce.models import HTMLField
 
 from accounts.models import Accessory
+from accounts.sms import enqueue_sms
+from .catalog import bump_catalog_version
 
 PAYMENT_STATES = [
     ('COMPLETED', 'COMPLETED'),
@@ -12,6 +21,13 @@ PAYMENT_STATES = [
     ('FAILED', 'FAILED')
 ]
 
+INITIATION_STATES = [
+    ('PENDING', 'PENDING'),
+    ('SENT', 'SENT'),
+    ('FAILED', 'FAILED'),
+    ('EXPIRED', 'EXPIRED'),
+]
+
 SERVICE_TYPE = [
     ('WORKSHOP', 'WORKSHOP'),
     ('TALK', 'TALK'),
@@ -63,6 +79,11 @@ class Presentation(models.Model):
 
     tags = models.ManyToManyField(PresentationTag, "presentation_tag", blank=True)
 
+    # Denormalized seat counters, kept in sync with atomic UPDATEs by reserve_seat(), release_seats() and
+    # ParticipationQuerySet. Run `manage.py reconcile_seat_counters` to repair any drift. Seats held by pending
+    # participations are counted in reserved_count until they are sold or their hold expires.
+    reserved_count = models.IntegerField(default=0, editable=False)
+    sold_count = models.IntegerField(default=0, editable=False)
 
     def clean(self):
         if self.cost < 0:
@@ -71,8 +92,74 @@ class Presentation(models.Model):
             raise ValidationError("End time must be after start time.")
 
     def get_remained_capacity(self):
-        return self.capacity - Participation.objects.filter(presentation=self, payment_state="COMPLETED").count()
-
+        return max(self.capacity - self.sold_count - self.reserved_count, 0)
+
+    def reserve_seat(self):
+        """
+        Hold a seat for a new pending participation, returns False if every seat is sold or held. Expired
+        holds still count until `manage.py release_expired_seat_holds` gives their seats to the waitlist.
+        """
+        reserved = Presentation.objects.filter(
+            pk=self.pk, capacity__gt=F('reserved_count') + F('sold_count')
+        ).update(reserved_count=F('reserved_count') + 1) == 1
+        if reserved:
+            # An update sends no post_save, and the remaining capacity in the catalog just changed.
+            bump_catalog_version()
+        return reserved
+
+    @staticmethod
+    def release_seats(presentation_id, count=1):
+        Presentation.objects.filter(pk=presentation_id).update(
+            reserved_count=Greatest(F('reserved_count') - count, 0)
+        )
+
+    @staticmethod
+    def promote_waitlist(presentation_id):
+        """
+        Hold the free seats of a presentation for the users at the head of its waitlist, in one transaction,
+        and queue an SMS to let them know. Returns the number of promoted users.
+        """
+        with transaction.atomic():
+            # Locked, so the seats can't be taken by someone else between counting and holding them.
+            presentation = Presentation.objects.select_for_update().get(pk=presentation_id)
+            free = presentation.get_remained_capacity()
+            if free < 1 or not presentation.is_registration_active or presentation.start <= timezone.now():
+                return 0
+
+            waitlist = WaitlistEntry.objects.filter(presentation=presentation)
+            # Users who got a seat on their own meanwhile just leave the waitlist, without taking a free seat.
+            waitlist.filter(user__in=Participation.objects.filter(
+                presentation=presentation, payment_state__in=["PENDING", "COMPLETED"]
+            ).values('user_id')).delete()
+            entries = list(waitlist.select_related('user').order_by('created_date', 'id')[:free])
+            if not entries:
+                return 0
+
+            promoted = [entry.user for entry in entries]
+            held_until = hold_expiry()
+            failed = set(Participation.objects.filter(
+                presentation=presentation, user__in=[user.id for user in promoted], payment_state="FAILED"
+            ).values_list('user_id', flat=True))
+            Participation.objects.filter(
+                presentation=presentation, user__in=failed, payment_state="FAILED"
+            ).update(payment_state="PENDING", held_until=held_until)
+            Participation.objects.bulk_create([
+                Participation(user=user, presentation=presentation, held_until=held_until)
+                for user in promoted if user.id not in failed
+            ])
+            WaitlistEntry.objects.filter(id__in=[entry.id for entry in entries]).delete()
+            Presentation.objects.filter(pk=presentation.pk).update(
+                reserved_count=F('reserved_count') + len(promoted)
+            )
+
+            message_text = (
+                f"Dear User, a seat in '{presentation.en_title}' is now held for you until "
+                f"{timezone.localtime(held_until):%H:%M}. Complete your payment to keep it."
+            )
+            enqueue_sms([user.phone_number for user in promoted], message_text, check_backlog=False)
+
+        bump_catalog_version()
+        return len(promoted)
 
     def participations(self):
         return Participation.objects.filter(presentation=self)
@@ -81,10 +168,170 @@ class Presentation(models.Model):
         return self.en_title
 
 
+def hold_expiry(seconds=None):
+    return timezone.now() + timedelta(seconds=seconds or settings.SEAT_HOLD_SECONDS)
+
+
+class ParticipationQuerySet(models.QuerySet):
+    def complete(self):
+        """
+        Mark the pending participations of this queryset as completed and move their seats from the reserved
+        to the sold counter of their presentations. Participations failed by an expired hold have been paid
+        for too, but their seat was given back and may have gone to someone else since. They are only
+        completed if their presentation still has a free seat, and are otherwise left failed, to be refunded,
+        see paid_without_seat. Returns the number of completed participations.
+        """
+        participations = list(
+            self.filter(payment_state__in=["PENDING", "FAILED"]).select_for_update().values_list(
+                'id', 'presentation_id', 'payment_state'
+            )
+        )
+        completed = {pk: presentation_id for pk, presentation_id, state in participations if state == "PENDING"}
+        held = Counter(completed.values())
+        for pk, presentation_id, state in participations:
+            if state == "FAILED" and Presentation.objects.filter(
+                pk=presentation_id, capacity__gt=F('reserved_count') + F('sold_count')
+            ).update(reserved_count=F('reserved_count') + 1):
+                completed[pk] = presentation_id
+                held[presentation_id] += 1
+        if not completed:
+            return 0
+
+        Participation.objects.filter(id__in=completed).update(payment_state="COMPLETED", held_until=None)
+        for presentation_id, count in held.items():
+            Presentation.objects.filter(pk=presentation_id).update(
+                reserved_count=Greatest(F('reserved_count') - count, 0),
+                sold_count=F('sold_count') + count,
+            )
+        # Queryset updates send no signals, remaining capacities are part of the catalog.
+        bump_catalog_version()
+        return len(completed)
+
+    def paid_without_seat(self):
+        """Failed participations of completed payments, paid for after their seat was given away."""
+        return self.filter(payment_state="FAILED", payments__payment_state="COMPLETED").distinct()
+
+    def release_expired(self, chunk_size=500):
+        """
+        Fail the pending participations of this queryset whose seat hold has expired and give their seats
+        back, in chunks of `chunk_size`. Returns the number of released holds.
+        """
+        released = 0
+        presentation_ids = set()
+        while True:
+            with transaction.atomic():
+                # Rows locked by a checkout are skipped, it is about to extend or complete their hold.
+                expired = list(
+                    self.filter(payment_state="PENDING", held_until__lt=timezone.now()).select_for_update(
+                        skip_locked=True
+                    ).values_list('id', 'presentation_id')[:chunk_size]
+                )
+                if not expired:
+                    break
+                Participation.objects.filter(id__in=[pk for pk, _ in expired]).update(
+                    payment_state="FAILED", held_until=None
+                )
+                for presentation_id, count in Counter(presentation_id for _, presentation_id in expired).items():
+                    Presentation.release_seats(presentation_id, count)
+                    presentation_ids.add(presentation_id)
+            released += len(expired)
+
+        for presentation_id in presentation_ids:
+            Presentation.promote_waitlist(presentation_id)
+        if released:
+            bump_catalog_version()
+        return released
+
+
 class Participation(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='participations')
     presentation = models.ForeignKey(Presentation, on_delete=models.CASCADE, related_name='participations')
     payment_state = models.CharField(choices=PAYMENT_STATES, default="PENDING", max_length=10)
+    held_until = models.DateTimeField(null=True, blank=True)
+
+    objects = ParticipationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'payment_state'], name='participation_user_state_idx'),
+            # Also serves lookups by (presentation, payment_state).
+            models.Index(fields=['presentation', 'payment_state', 'held_until'], name='participation_hold_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'presentation'], name='participation_user_presentation_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.phone_number} - {self.presentation.en_title}'
+
+
+# Without look-alikes such as 0 and O, since codes are typed in by hand.
+COUPON_CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+
+
+class CouponQuerySet(models.QuerySet):
+    def generate(self, count, prefix='', percentage=0, uses=1, length=8, batch_size=1000):
+        """
+        Create `count` coupons with unique random codes made of `prefix` and `length` random characters, each
+        usable `uses` times, with one bulk insert per `batch_size` coupons. Returns the created coupons.
+        """
+        if len(prefix) + length > Coupon._meta.get_field('name').max_length:
+            raise ValueError('Coupon codes would be too long, use a shorter prefix.')
+        if '/' in prefix:
+            raise ValueError("Don't use / in the prefix.")
+        if not 0 <= percentage <= 100:
+            raise ValueError('Enter a percentage between 0 to 100.')
+        if length < 1:
+            raise ValueError('Coupon codes need at least one random character.')
+
+        coupons = []
+        with transaction.atomic():
+            # Random codes only keep colliding rarely while most of the code space is free.
+            taken = self.filter(name__startswith=prefix).annotate(name_length=Length('name')).filter(
+                name_length=len(prefix) + length
+            ).count()
+            if len(COUPON_CODE_ALPHABET) ** length < 4 * (taken + count):
+                raise ValueError(f'Not enough free {length} character codes for the prefix, use a longer length.')
+
+            rounds, fruitless = 0, 0
+            while len(coupons) < count:
+                rounds += 1
+                # With at most a quarter of the codes taken, ten batches in a row without a free code only
+                # happen when something else is taking them too.
+                if rounds > count // batch_size + 20 or fruitless >= 10:
+                    raise ValueError('Could not find enough free coupon codes, use a longer length.')
+                names = {
+                    prefix + ''.join(secrets.choice(COUPON_CODE_ALPHABET) for _ in range(length))
+                    for _ in range(min(batch_size, count - len(coupons)))
+                }
+                # Codes are looked up by primary key, so skipping the taken ones costs one IN query per batch.
+                names -= set(self.filter(name__in=names).values_list('name', flat=True))
+                fruitless = 0 if names else fruitless + 1
+                batch = [Coupon(name=name, count=uses, percentage=percentage) for name in sorted(names)]
+                self.bulk_create(batch)
+                coupons.extend(batch)
+        return coupons
+
+
+class WaitlistEntry(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='waitlist_entries')
+    presentation = models.ForeignKey(Presentation, on_delete=models.CASCADE, related_name='waitlist')
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'waitlist entries'
+        indexes = [
+            models.Index(fields=['presentation', 'created_date'], name='waitlist_presentation_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'presentation'], name='waitlist_user_presentation_unique'),
+        ]
+
+    def position(self):
+        """Position of the entry in its presentation's waitlist, starting from 1."""
+        return WaitlistEntry.objects.filter(presentation_id=self.presentation_id).filter(
+            models.Q(created_date__lt=self.created_date) | models.Q(created_date=self.created_date, id__lt=self.id)
+        ).count() + 1
 
     def __str__(self):
         return f'{self.user.phone_number} - {self.presentation.en_title}'
@@ -95,6 +342,8 @@ class Coupon(models.Model):
     count = models.PositiveIntegerField()
     percentage = models.IntegerField(default=0.0, help_text='Enter a number between 0 to 100.')
 
+    objects = CouponQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -107,6 +356,14 @@ class Coupon(models.Model):
     def is_valid(self):
         return self.count > 0
 
+    @staticmethod
+    def redeem(name, count=1):
+        """
+        Use up `count` of a coupon with one conditional UPDATE instead of a locked read-modify-write.
+        Returns False, and leaves the coupon as is, if fewer than `count` are left.
+        """
+        return Coupon.objects.filter(pk=name, count__gte=count).update(count=F('count') - count) == 1
+
 
 class Payment(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='payments')
@@ -114,7 +371,7 @@ class Payment(models.Model):
     participations = models.ManyToManyField(Participation, related_name='payments')
     payment_state = models.CharField(choices=PAYMENT_STATES, default="PENDING", max_length=10)
 
-    authority = models.CharField(null=True, max_length=100)
+    authority = models.CharField(null=True, max_length=100, unique=True)
     pay_link = models.URLField(null=True)
     ref_id = models.CharField(null=True, max_length=100)
     card_pan = models.TextField(null=True)
@@ -125,5 +382,37 @@ class Payment(models.Model):
     accessories = models.ManyToManyField(Accessory, "payment_accessories")
     is_competition_payment = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_date'], name='payment_user_created_idx'),
+            models.Index(fields=['payment_state', 'created_date'], name='payment_state_created_idx'),
+            models.Index(fields=['coupon', 'payment_state'], name='payment_coupon_state_idx'),
+        ]
+
     def __str__(self):
         return f'Payment {self.pk} - {self.user.phone_number} - {self.total_price}'
+
+
+class PaymentInitiation(models.Model):
+    """
+    Outbox record for the gateway request of a payment. It is created with the payment in the first phase
+    of checkout, and stays PENDING until the gateway has answered, so initiations interrupted by a crash
+    can be retried or expired by `manage.py process_payment_initiations`. Initiations that failed to reach
+    the gateway stay PENDING too, and are retried from `next_attempt` on.
+    """
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name='initiation')
+    state = models.CharField(choices=INITIATION_STATES, default="PENDING", max_length=10)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'created_date'], name='initiation_state_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'Initiation of payment {self.payment_id} - {self.state}'
@@ -0,0 +1,59 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+
+class PaymentCursorPagination(CursorPagination):
+    ordering = '-created_date'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+def table_rows_estimate(connection, table):
+    """The number of rows of `table` according to the MySQL table statistics, cheap but approximate."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+            [table],
+        )
+        row = cursor.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def explain_rows_estimate(connection, queryset):
+    """The number of rows MySQL's query planner expects `queryset` to return."""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN {sql}', params)
+        columns = [column[0] for column in cursor.description]
+        plan = dict(zip(columns, cursor.fetchone()))
+    return int((plan.get('rows') or 0) * float(plan.get('filtered') or 100) / 100)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Admin paginator for big tables, where an exact COUNT(*) is a full index scan on InnoDB. On MySQL, an
+    unfiltered changelist of a table past `threshold` rows is counted from the table statistics, and a
+    filtered one exactly as long as it has less than `threshold` rows, and from the query plan past that.
+    The page numbers at the end of a big changelist can be a little off.
+    """
+    threshold = 100_000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'mysql':
+            return super().count
+
+        if not queryset.query.has_filters():
+            estimate = table_rows_estimate(connection, queryset.model._meta.db_table)
+            return estimate if estimate >= self.threshold else super().count
+
+        # Counts at most `threshold` rows.
+        count = queryset.values('pk')[:self.threshold].count()
+        if count < self.threshold:
+            return count
+        return max(explain_rows_estimate(connection, queryset), count)
@@ -1,16 +1,102 @@
+import asyncio
+import random
+import threading
+import time
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+
 from backend import settings
 
 
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `failure_threshold` consecutive gateway failures, until `reset_timeout` seconds have
+    passed. Then one trial request is let through, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError('Payment gateway is unavailable, try again later.')
+            # Half-open: let this request through, and keep failing fast until it reports back.
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def build_session(pool_maxsize=20):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Content-Type': 'application/json',
+        'Accept': 'application/json'
+    })
+    return session
+
+
+# Shared by every request of the process so gateway connections are kept alive between checkouts.
+SESSION = build_session()
+CIRCUIT_BREAKER = CircuitBreaker()
+
+# httpx connections belong to the event loop they were opened on, so the shared async clients are kept per
+# loop. backend.asgi opens one on the server's loop at lifespan startup and closes it at shutdown.
+ASYNC_CLIENTS = {}
+
+
+def build_async_client():
+    return httpx.AsyncClient(
+        headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+        timeout=httpx.Timeout(ZarrinPal.TIMEOUT[1], connect=ZarrinPal.TIMEOUT[0]),
+        limits=httpx.Limits(max_connections=500, max_keepalive_connections=50),
+    )
+
+
+async def open_async_client():
+    ASYNC_CLIENTS[asyncio.get_running_loop()] = build_async_client()
+
+
+async def close_async_client():
+    client = ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
 class ZarrinPal:
     merchant_id = settings.PAYMENT_API_KEY
 
     PAYMENT_DESCRIPTION = 'Register workshops or talks'
     CALLBACK_URL = settings.PAYMENT_CALLBACK_URL
 
-    PAY_URL = "https://payment.zarinpal.com/pg/v4/payment/request.json"
-    VERIFY_URL = "https://payment.zarinpal.com/pg/v4/payment/verify.json"
-    START_PAY_URL = "https://payment.zarinpal.com/pg/StartPay/{authority}"
+    GATEWAY_URL = settings.PAYMENT_GATEWAY_URL
+    PAY_URL = f"{GATEWAY_URL}/pg/v4/payment/request.json"
+    VERIFY_URL = f"{GATEWAY_URL}/pg/v4/payment/verify.json"
+    START_PAY_URL = GATEWAY_URL + "/pg/StartPay/{authority}"
 
     STATUS_SUCCESS = 100
     STATUS_VERIFIED = 101
@@ -18,13 +104,45 @@ class ZarrinPal:
     STATUS_API_KEY_ERROR = 10
     STATUS_FAILED = 51
 
+    TIMEOUT = (3.05, 10)  # (connect, read) seconds
+    VERIFY_ATTEMPTS = 3
+    RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+
+    def __init__(self, session=None, circuit_breaker=None):
+        self.session = session or SESSION
+        self.circuit_breaker = circuit_breaker or CIRCUIT_BREAKER
 
     def generate_link(self, authority):
         link = self.START_PAY_URL
         return link.format(authority=authority)
 
+    def post(self, url, data):
+        self.circuit_breaker.before_request()
+        try:
+            response = self.session.post(url, json=data, timeout=self.TIMEOUT)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            payload = response.json()
+        except (requests.RequestException, ValueError):
+            self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        # Rejected requests come back with an empty `data` and the code and message under `errors`.
+        return payload.get('data') or payload.get('errors') or {}
 
-    def create_payment(self, amount, mobile, email):
+    def post_with_retry(self, url, data):
+        """Post an idempotent request, retrying transport failures with exponential backoff and full jitter."""
+        for attempt in range(self.VERIFY_ATTEMPTS):
+            try:
+                return self.post(url, data)
+            except CircuitOpenError:
+                raise
+            except (requests.RequestException, ValueError):
+                if attempt == self.VERIFY_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, self.RETRY_BACKOFF * 2 ** attempt))
+
+    def create_payment_data(self, amount, mobile, email):
         data = {
             "merchant_id": self.merchant_id,
             "amount": amount * 10,  # Convert Toman to Rial
@@ -34,76 +152,150 @@ class ZarrinPal:
         }
         data["metadata"]["mobile"] = mobile
         data["metadata"]["email"] = email
+        return data
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
+    def create_payment_result(self, response_data):
+        code = response_data.get('code')
 
-        try:
-            response = requests.post(self.PAY_URL, json=data, headers=headers)
-            response_data = response.json().get('data', {})
-            code = response_data.get('code')
-
-            if code == self.STATUS_SUCCESS:
-                return {
-                    'status': 'success',
-                    'authority': response_data.get('authority'),
-                    'error': None,
-                    'link': self.generate_link(response_data.get('authority'))
-                }
-            else:
-                return {
-                    'status': 'failed',
-                    'authority': None,
-                    'error': response_data.get('message'),
-                    'link': None
-                }
-        except requests.RequestException as e:
+        if code == self.STATUS_SUCCESS:
             return {
-                'status': 'error',
+                'status': 'success',
+                'authority': response_data.get('authority'),
+                'error': None,
+                'link': self.generate_link(response_data.get('authority'))
+            }
+        else:
+            return {
+                'status': 'failed',
                 'authority': None,
-                'error': str(e),
+                'error': response_data.get('message'),
                 'link': None
             }
 
+    @staticmethod
+    def create_payment_error(error):
+        return {
+            'status': 'error',
+            'authority': None,
+            'error': str(error),
+            'link': None
+        }
 
-    def verify_payment(self, authority, amount):
-        data = {
+    def verify_payment_data(self, authority, amount):
+        return {
             "merchant_id": self.merchant_id,
             "amount": amount * 10,  # Convert Toman to Rial
             "authority": authority
         }
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
+    def verify_payment_result(self, response_data):
+        code = response_data.get('code')
 
-        try:
-            response = requests.post(self.VERIFY_URL, json=data, headers=headers)
-            print(response.json())
-            response_data = response.json().get('data', {})
-            code = response_data.get('code')
-
-            if code == self.STATUS_SUCCESS or code == self.STATUS_VERIFIED:
-                return {
-                    'status': 'success',
-                    'ref_id': response_data.get('ref_id'),
-                    'error': None,
-                    'card_pan': response_data.get('card_pan'),
-                }
-            else:
-                return {
-                    'status': 'failed',
-                    'ref_id': None,
-                    'error': response_data.get('message'),
-                    'card_pan': None,
-                }
-        except requests.RequestException as e:
+        if code == self.STATUS_SUCCESS or code == self.STATUS_VERIFIED:
             return {
-                'status': 'unexpected',
+                'status': 'success',
+                'ref_id': response_data.get('ref_id'),
+                'error': None,
+                'card_pan': response_data.get('card_pan'),
+            }
+        else:
+            return {
+                'status': 'failed',
                 'ref_id': None,
-                'error': str(e),
+                'error': response_data.get('message'),
                 'card_pan': None,
-            }
\ No newline at end of file
+            }
+
+    @staticmethod
+    def verify_payment_error(error):
+        return {
+            'status': 'unexpected',
+            'ref_id': None,
+            'error': str(error),
+            'card_pan': None,
+        }
+
+    def create_payment(self, amount, mobile, email):
+        try:
+            # Not retried: a lost response may still have created an authority at the gateway.
+            response_data = self.post(self.PAY_URL, self.create_payment_data(amount, mobile, email))
+        except (requests.RequestException, ValueError) as e:
+            return self.create_payment_error(e)
+        return self.create_payment_result(response_data)
+
+    def verify_payment(self, authority, amount):
+        try:
+            response_data = self.post_with_retry(self.VERIFY_URL, self.verify_payment_data(authority, amount))
+        except (requests.RequestException, ValueError) as e:
+            return self.verify_payment_error(e)
+        return self.verify_payment_result(response_data)
+
+
+class AsyncZarrinPal(ZarrinPal):
+    """
+    Non-blocking variant of ZarrinPal for async views, sharing its circuit breaker. Used as an async context
+    manager:
+
+        async with AsyncZarrinPal() as zarrinpal:
+            result = await zarrinpal.create_payment(...)
+
+    Under ASGI every request runs on the server's event loop, and uses the client opened for it at lifespan
+    startup, so gateway connections are kept alive between checkouts. On a loop without one, e.g. when the
+    async views are served by runserver, the request gets a client of its own, closed on exit.
+    """
+
+    GATEWAY_ERRORS = (httpx.HTTPError, CircuitOpenError, ValueError)
+
+    def __init__(self, client=None, circuit_breaker=None):
+        super().__init__(circuit_breaker=circuit_breaker)
+        self.client = client
+        self.owns_client = False
+
+    async def __aenter__(self):
+        if self.client is None:
+            self.client = ASYNC_CLIENTS.get(asyncio.get_running_loop())
+        if self.client is None:
+            self.client = build_async_client()
+            self.owns_client = True
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.owns_client:
+            await self.client.aclose()
+            self.client, self.owns_client = None, False
+
+    async def post(self, url, data):
+        self.circuit_breaker.before_request()
+        try:
+            response = await self.client.post(url, json=data)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            payload = response.json()
+        except (httpx.HTTPError, ValueError):
+            self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        return payload.get('data') or payload.get('errors') or {}
+
+    async def post_with_retry(self, url, data):
+        for attempt in range(self.VERIFY_ATTEMPTS):
+            try:
+                return await self.post(url, data)
+            except (httpx.HTTPError, ValueError):
+                if attempt == self.VERIFY_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(random.uniform(0, self.RETRY_BACKOFF * 2 ** attempt))
+
+    async def create_payment(self, amount, mobile, email):
+        try:
+            response_data = await self.post(self.PAY_URL, self.create_payment_data(amount, mobile, email))
+        except self.GATEWAY_ERRORS as e:
+            return self.create_payment_error(e)
+        return self.create_payment_result(response_data)
+
+    async def verify_payment(self, authority, amount):
+        try:
+            response_data = await self.post_with_retry(self.VERIFY_URL, self.verify_payment_data(authority, amount))
+        except self.GATEWAY_ERRORS as e:
+            return self.verify_payment_error(e)
+        return self.verify_payment_result(response_data)
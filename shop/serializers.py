@@ -30,18 +30,28 @@ class PresentationSerializer(serializers.ModelSerializer):
         extra_kwargs = {'id': {'read_only': True}, 'presentation_link': {'read_only': True}}
 
 
+class CartPresentationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Presentation
+        fields = ['id', 'en_title', 'fa_title', 'start', 'end', 'cost']
+
+
 class CartSerializer(serializers.ModelSerializer):
     payment_state = serializers.CharField(source='get_payment_state_display')
     service_type = serializers.CharField(source='presentation.get_service_type_display')
-    presentation = PresentationSerializer(read_only=True)
+    presentation = CartPresentationSerializer(read_only=True)
 
     class Meta:
         model = Participation
-        fields = ['id', 'presentation', 'payment_state', 'service_type']
+        fields = ['id', 'presentation', 'payment_state', 'held_until', 'service_type']
         extra_kwargs = {'service_type': {'read_only': True}, 'payment_state': {'read_only': True}
                         , 'presentation': {'read_only': True}, 'id': {'read_only': True}}
 
 
+class CartDetailSerializer(CartSerializer):
+    presentation = PresentationSerializer(read_only=True)
+
+
 class ParticipationSerializer(serializers.ModelSerializer):
     presentation = PresentationSerializer(read_only=True)
     class Meta:
@@ -0,0 +1,25 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from accounts.models import Staff, FAQ, Accessory
+from .catalog import bump_catalog_version
+from .models import Presentation, Presenter, PresentationTag, Participation
+
+CATALOG_MODELS = [Presentation, Presenter, PresentationTag, Staff, FAQ, Accessory, Participation]
+CATALOG_RELATIONS = [Presentation.presenters.through, Presentation.tags.through]
+
+
+def catalog_changed(sender, **kwargs):
+    bump_catalog_version()
+
+
+def catalog_relation_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_catalog_version()
+
+
+for model in CATALOG_MODELS:
+    post_save.connect(catalog_changed, sender=model)
+    post_delete.connect(catalog_changed, sender=model)
+
+for through in CATALOG_RELATIONS:
+    m2m_changed.connect(catalog_relation_changed, sender=through)
@@ -1,3 +1,1009 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings, AsyncClient
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.test import APITestCase, APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import User, SMSMessage, Accessory
+from backend.asgi import application
+from .exports import registration_rows
+from .fake_gateway import FakeGateway, REQUEST_PATH, VERIFY_PATH, START_PAY_PATH, SERVER_ERROR, TIMEOUT
+from .models import Presenter, PresentationTag, Presentation, Participation, Payment, PaymentInitiation, Coupon, \
+    WaitlistEntry
+from .pagination import EstimatedCountPaginator
+from .payments import ZarrinPal, AsyncZarrinPal, CircuitBreaker, build_session
+from .throttling import check_atomic_caches
+
+
+class ShopTestCase(APITestCase):
+    def setUp(self):
+        self.base_url = '/api/'
+        self.client = APIClient()
+        self.user = User.objects.create_user(phone_number='09337905450', password='te123456',
+                                             first_name='test', last_name='test', email='test@gmail.com',
+                                             is_active=True)
+
+    def create_presentation(self, title='Linux 101', capacity=30, cost=100_000, **kwargs):
+        start = timezone.now() + timedelta(days=7)
+        return Presentation.objects.create(
+            service_type='WORKSHOP', en_title=title, fa_title=title, start=start, end=start + timedelta(hours=2),
+            en_description='', fa_description='', capacity=capacity, cost=cost, **kwargs
+        )
+
+    def create_catalog(self, count):
+        tag = PresentationTag.objects.create(name='kernel')
+        offset = Presentation.objects.count()
+        for i in range(offset, offset + count):
+            presentation = self.create_presentation(title=f'Presentation {i}')
+            presenter = Presenter.objects.create(first_name=f'Presenter {i}', last_name='test', description='')
+            presentation.presenters.add(presenter)
+            presentation.tags.add(tag)
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# Stands in for Redis, the tests run in one process.
+WAITING_ROOM_CACHES = {**LOCMEM_CACHES, 'waiting_room': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PresentationTestCase(ShopTestCase):
+    def test_all_query_count_does_not_grow(self):
+        self.create_catalog(2)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.base_url + 'presentations/all/')
+        self.assertEqual(len(response.data), 2)
+
+        self.create_catalog(10)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.base_url + 'presentations/all/')
+        self.assertEqual(len(response.data), 12)
+
+    def test_all_remained_capacity(self):
+        presentation = self.create_presentation(capacity=5)
+        Participation.objects.create(user=self.user, presentation=presentation)
+        Participation.objects.filter(presentation=presentation).complete()
+
+        response = self.client.get(self.base_url + 'presentations/all/')
+        self.assertEqual(response.data[0]['remained_capacity'], 4)
+
+
+class SeatCounterTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_add_and_remove_participation(self):
+        presentation = self.create_presentation()
+
+        response = self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+        self.assertEqual(response.status_code, 201)
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.sold_count), (1, 0))
+
+        participation = Participation.objects.get(user=self.user, presentation=presentation)
+        response = self.client.delete(self.base_url + f'presentations/{participation.id}/remove_participation/')
+        self.assertEqual(response.status_code, 200)
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.sold_count), (0, 0))
+
+    def test_duplicate_participation(self):
+        presentation = self.create_presentation()
+        self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], 'Already participating in this presentation.')
+        self.assertFalse([query for query in queries if 'FROM "shop_participation"' in query['sql']
+                          and query['sql'].startswith('SELECT')])
+        presentation.refresh_from_db()
+        self.assertEqual(presentation.reserved_count, 1)
+
+    def test_free_checkout_moves_reserved_to_sold(self):
+        presentation = self.create_presentation(cost=0)
+        self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+
+        response = self.client.post(self.base_url + 'payments/pay_all/', data={}, format='json')
+        self.assertEqual(response.status_code, 204)
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.sold_count), (0, 1))
+        self.assertEqual(presentation.get_remained_capacity(), presentation.capacity - 1)
+
+    def test_full_presentation_rejects_participation(self):
+        presentation = self.create_presentation(capacity=1)
+        Presentation.objects.filter(pk=presentation.pk).update(sold_count=1)
+
+        response = self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Participation.objects.filter(presentation=presentation).exists())
+
+    def test_reconcile_seat_counters(self):
+        presentation = self.create_presentation()
+        Participation.objects.create(user=self.user, presentation=presentation)
+        Presentation.objects.filter(pk=presentation.pk).update(reserved_count=7, sold_count=3)
+
+        call_command('reconcile_seat_counters', stdout=StringIO())
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.sold_count), (1, 0))
+
+
+class SeatHoldTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create_user(phone_number='09120000001', password='te123456', first_name='test',
+                                                   last_name='test', email='other@gmail.com', is_active=True)
+
+    def add_participation(self, user, presentation):
+        self.client.force_authenticate(user)
+        return self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+
+    def expire_holds(self):
+        Participation.objects.filter(payment_state='PENDING').update(held_until=timezone.now() - timedelta(seconds=1))
+
+    def test_holds_count_against_capacity(self):
+        presentation = self.create_presentation(capacity=1)
+        self.assertEqual(self.add_participation(self.user, presentation).status_code, 201)
+        self.assertEqual(self.add_participation(self.other_user, presentation).status_code, 400)
+
+        # An expired hold keeps its seat until it is swept.
+        self.expire_holds()
+        self.assertEqual(self.add_participation(self.other_user, presentation).status_code, 400)
+        call_command('release_expired_seat_holds', stdout=StringIO())
+        self.assertEqual(self.add_participation(self.other_user, presentation).status_code, 201)
+        self.assertEqual(Participation.objects.get(user=self.user).payment_state, 'FAILED')
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.get_remained_capacity()), (1, 0))
+
+    def test_release_expired_seat_holds(self):
+        presentations = [self.create_presentation(), self.create_presentation()]
+        for presentation in presentations:
+            self.add_participation(self.user, presentation)
+            self.add_participation(self.other_user, presentation)
+        self.expire_holds()
+        held = Participation.objects.get(user=self.user, presentation=presentations[0])
+        Participation.objects.filter(pk=held.pk).update(held_until=timezone.now() + timedelta(minutes=5))
+
+        out = StringIO()
+        call_command('release_expired_seat_holds', '--chunk-size', '1', stdout=out)
+        self.assertIn('Released 3 expired seat hold(s).', out.getvalue())
+        self.assertEqual(
+            list(Presentation.objects.order_by('id').values_list('reserved_count', flat=True)), [1, 0]
+        )
+
+        # A paid participation is completed even if its hold expired meanwhile, and a failed one can be re-added.
+        Participation.objects.filter(user=self.other_user, presentation=presentations[0]).complete()
+        self.assertEqual(self.add_participation(self.user, presentations[1]).status_code, 201)
+        self.assertEqual(
+            list(Presentation.objects.order_by('id').values_list('reserved_count', 'sold_count')), [(1, 1), (1, 0)]
+        )
+
+    def test_sweeper_keeps_sweeping(self):
+        presentation = self.create_presentation()
+        self.add_participation(self.user, presentation)
+        self.expire_holds()
+
+        out = StringIO()
+        command = 'shop.management.commands.release_expired_seat_holds'
+        with mock.patch(f'{command}.time.sleep', side_effect=[None, KeyboardInterrupt()]) as sleep, \
+                mock.patch(f'{command}.close_old_connections'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('release_expired_seat_holds', '--loop', '--interval', '5', stdout=out)
+        sleep.assert_called_with(5)
+        self.assertEqual(out.getvalue().count('Released 1 expired seat hold(s).'), 1)
+        presentation.refresh_from_db()
+        self.assertEqual(presentation.reserved_count, 0)
+
+
+class WaitlistTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create_user(phone_number='09120000001', password='te123456', first_name='test',
+                                                   last_name='test', email='other@gmail.com', is_active=True)
+
+    add_participation = SeatHoldTestCase.add_participation
+    expire_holds = SeatHoldTestCase.expire_holds
+
+    def join_waitlist(self, user, presentation):
+        self.client.force_authenticate(user)
+        return self.client.post(self.base_url + f'presentations/{presentation.id}/join_waitlist/')
+
+    def test_join_waitlist(self):
+        presentation = self.create_presentation(capacity=1)
+        self.assertEqual(self.join_waitlist(self.other_user, presentation).status_code, 400)  # Seats are free.
+
+        self.add_participation(self.user, presentation)
+        self.assertEqual(self.join_waitlist(self.user, presentation).status_code, 400)
+        response = self.join_waitlist(self.other_user, presentation)
+        self.assertEqual((response.status_code, response.data['position']), (201, 1))
+        response = self.join_waitlist(self.other_user, presentation)
+        self.assertEqual((response.status_code, response.data['position']), (200, 1))
+
+        response = self.client.delete(self.base_url + f'presentations/{presentation.id}/leave_waitlist/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(WaitlistEntry.objects.exists())
+
+    def test_freed_seat_goes_to_the_waitlist(self):
+        presentation = self.create_presentation(capacity=1)
+        self.add_participation(self.user, presentation)
+        participation = Participation.objects.get(user=self.user)
+        self.join_waitlist(self.other_user, presentation)
+
+        self.client.force_authenticate(self.user)
+        response = self.client.delete(self.base_url + f'presentations/{participation.id}/remove_participation/')
+        self.assertEqual(response.status_code, 200)
+
+        promoted = Participation.objects.get(user=self.other_user)
+        self.assertEqual(promoted.payment_state, 'PENDING')
+        self.assertIsNotNone(promoted.held_until)
+        self.assertFalse(WaitlistEntry.objects.exists())
+        self.assertEqual(list(SMSMessage.objects.values_list('mobile', flat=True)), [self.other_user.phone_number])
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.get_remained_capacity()), (1, 0))
+
+        # An expired hold is passed on the same way.
+        self.join_waitlist(self.user, presentation)
+        self.expire_holds()
+        call_command('release_expired_seat_holds', stdout=StringIO())
+        self.assertEqual(Participation.objects.get(user=self.user).payment_state, 'PENDING')
+        self.assertEqual(Participation.objects.get(user=self.other_user).payment_state, 'FAILED')
+
+    def test_late_payment_does_not_oversell(self):
+        presentation = self.create_presentation(capacity=1)
+        self.add_participation(self.user, presentation)
+        participation = Participation.objects.get(user=self.user)
+        payment = Payment.objects.create(user=self.user, total_price=presentation.cost, authority='A1')
+        payment.participations.add(participation)
+        self.join_waitlist(self.other_user, presentation)
+        self.expire_holds()
+        call_command('release_expired_seat_holds', stdout=StringIO())
+        self.assertEqual(Participation.objects.get(user=self.other_user).payment_state, 'PENDING')
+
+        verified = {'status': 'success', 'ref_id': 7, 'error': None, 'card_pan': '6037'}
+        with mock.patch.object(ZarrinPal, 'verify_payment', return_value=verified):
+            response = self.client.post(self.base_url + 'payments/verify/', data={'authority': 'A1'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unseated'], [presentation.en_title])
+        self.assertEqual(list(Participation.objects.paid_without_seat()), [participation])
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.sold_count), (1, 0))
+
+        # Paid before anyone else took the seat, it is taken up again.
+        Participation.objects.filter(user=self.other_user).delete()
+        Presentation.release_seats(presentation.id)
+        Participation.objects.filter(pk=participation.pk).complete()
+        presentation.refresh_from_db()
+        self.assertEqual((presentation.reserved_count, presentation.sold_count), (0, 1))
+        self.assertFalse(Participation.objects.paid_without_seat().exists())
+
+    def test_users_with_a_seat_do_not_take_a_free_one(self):
+        presentation = self.create_presentation(capacity=1)
+        self.add_participation(self.user, presentation)
+        third_user = User.objects.create_user(phone_number='09120000002', password='te123456', first_name='test',
+                                              last_name='test', email='third@gmail.com', is_active=True)
+        self.join_waitlist(self.other_user, presentation)
+        self.join_waitlist(third_user, presentation)
+        # other_user got a seat of their own meanwhile, e.g. after the capacity was raised.
+        Participation.objects.create(user=self.other_user, presentation=presentation)
+
+        Presentation.objects.filter(pk=presentation.pk).update(capacity=2, reserved_count=2)
+        Participation.objects.filter(user=self.user).delete()
+        Presentation.release_seats(presentation.id)
+        self.assertEqual(Presentation.promote_waitlist(presentation.id), 1)
+        self.assertEqual(Participation.objects.get(user=third_user).payment_state, 'PENDING')
+        self.assertFalse(WaitlistEntry.objects.exists())
+
+
+@override_settings(CACHES=WAITING_ROOM_CACHES, WAITING_ROOM_RATE=2, WAITING_ROOM_BURST=2)
+class WaitingRoomTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        caches['waiting_room'].clear()
+        self.presentation = self.create_presentation()
+        self.users = [
+            User.objects.create_user(phone_number=f'0912000000{i}', password='te123456', first_name='test',
+                                     last_name='test', email=f'test{i}@gmail.com', is_active=True)
+            for i in range(5)
+        ]
+
+    def add_participation(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post(self.base_url + f'presentations/{self.presentation.id}/add_participation/')
+
+    def test_clients_are_admitted_in_order(self):
+        now = time.time()
+        with mock.patch('shop.throttling.time.time', return_value=now):
+            self.assertEqual([self.add_participation(user).status_code for user in self.users[:2]], [201, 201])
+
+            response = self.add_participation(self.users[2])
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(response.data['position'], 1)
+            self.assertEqual(self.add_participation(self.users[3]).data['position'], 2)
+            self.assertEqual(self.add_participation(self.users[4]).data['position'], 3)
+
+            # Retries keep their place, and admitted clients stay admitted.
+            self.assertEqual(self.add_participation(self.users[3]).data['position'], 2)
+            self.assertEqual(self.add_participation(self.users[0]).status_code, 400)
+
+        with mock.patch('shop.throttling.time.time', return_value=now + 1):
+            self.assertEqual([self.add_participation(user).status_code for user in self.users[2:]], [201, 201, 429])
+        self.assertEqual(Participation.objects.count(), 4)
+
+        # Other presentations have their own waiting room.
+        self.presentation = self.create_presentation()
+        self.assertEqual(self.add_participation(self.users[4]).status_code, 201)
+
+    def test_waiting_clients_only_read_the_cache(self):
+        now = time.time()
+        with mock.patch('shop.throttling.time.time', return_value=now):
+            for user in self.users[:3]:
+                self.add_participation(user)
+            room_cache = caches['waiting_room']
+            with mock.patch.object(room_cache, 'set', wraps=room_cache.set) as cache_set:
+                self.assertEqual(self.add_participation(self.users[2]).status_code, 429)
+            cache_set.assert_not_called()
+
+    @override_settings(AUTH_THROTTLE_RATES={})
+    def test_needs_an_atomic_cache(self):
+        for backend, errors in [('django.core.cache.backends.redis.RedisCache', []),
+                                ('django.core.cache.backends.db.DatabaseCache', ['shop.E001'])]:
+            with override_settings(CACHES={**LOCMEM_CACHES, 'waiting_room': {'BACKEND': backend}}):
+                self.assertEqual([error.id for error in check_atomic_caches(None)], errors)
+        with override_settings(WAITING_ROOM_RATE=0):
+            self.assertEqual(check_atomic_caches(None), [])
+
+
+class CatalogConditionTestCase(ShopTestCase):
+    def test_not_modified_until_catalog_changes(self):
+        presentation = self.create_presentation()
+
+        response = self.client.get(self.base_url + 'presentations/all/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(self.base_url + 'presentations/all/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            presentation.capacity = 10
+            presentation.save()
+
+        response = self.client.get(self.base_url + 'presentations/all/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_changes_within_a_second_are_not_missed(self):
+        presentation = self.create_presentation()
+        response = self.client.get(self.base_url + 'presentations/all/')
+        self.assertNotIn('Last-Modified', response)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            presentation.capacity = 10
+            presentation.save()
+        response = self.client.get(self.base_url + 'presentations/all/', HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+
+    def test_retaken_participation_changes_the_catalog(self):
+        presentation = self.create_presentation()
+        Participation.objects.create(user=self.user, presentation=presentation, payment_state='FAILED')
+        etag = self.client.get(self.base_url + 'presentations/all/')['ETag']
+
+        self.client.force_authenticate(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.base_url + f'presentations/{presentation.id}/add_participation/')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(self.base_url + 'presentations/all/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_modified_list_endpoints(self):
+        for endpoint in ['presenter/', 'staff/', 'faq/', 'accessory/']:
+            etag = self.client.get(self.base_url + endpoint)['ETag']
+            response = self.client.get(self.base_url + endpoint, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, endpoint)
+
+
+class CartTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.create_catalog(3)
+        for presentation in Presentation.objects.all():
+            Participation.objects.create(user=self.user, presentation=presentation)
+
+    def test_cart_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.base_url + 'presentations/cart/')
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response.data[0]['service_type'], 'WORKSHOP')
+        self.assertNotIn('en_description', response.data[0]['presentation'])
+
+    def test_full_cart(self):
+        with self.assertNumQueries(3):
+            response = self.client.get(self.base_url + 'presentations/cart/', {'full': 'true'})
+        self.assertEqual(len(response.data[0]['presentation']['presenters']), 1)
+
+
+class PaymentListTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.create_catalog(2)
+
+    def create_payments(self, count, payment_state='FAILED'):
+        participations = [
+            Participation.objects.get_or_create(user=self.user, presentation=presentation)[0]
+            for presentation in Presentation.objects.all()
+        ]
+        for _ in range(count):
+            payment = Payment.objects.create(user=self.user, total_price=100_000, payment_state=payment_state)
+            payment.participations.set(participations)
+
+    def test_query_count_does_not_grow(self):
+        self.create_payments(2)
+        with self.assertNumQueries(5):
+            response = self.client.get(self.base_url + 'payments/get_list/')
+        self.assertEqual(len(response.data['results']), 2)
+
+        self.create_payments(10)
+        with self.assertNumQueries(5):
+            response = self.client.get(self.base_url + 'payments/get_list/')
+        self.assertEqual(len(response.data['results']), 12)
+
+    def test_pagination_and_state_filter(self):
+        self.create_payments(25)
+        self.create_payments(1, payment_state='COMPLETED')
+
+        response = self.client.get(self.base_url + 'payments/get_list/')
+        self.assertEqual(len(response.data['results']), 20)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 6)
+
+        response = self.client.get(self.base_url + 'payments/get_list/', {'state': 'COMPLETED'})
+        self.assertEqual(len(response.data['results']), 1)
+
+        response = self.client.get(self.base_url + 'payments/get_list/', {'state': 'UNKNOWN'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PayAllValidationTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_reports_every_violation(self):
+        closed = self.create_presentation(title='Closed')
+        full = self.create_presentation(title='Full', capacity=1)
+        for presentation in (closed, full):
+            Participation.objects.create(user=self.user, presentation=presentation)
+        Presentation.objects.filter(pk=closed.pk).update(is_registration_active=False)
+        Presentation.objects.filter(pk=full.pk).update(sold_count=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.base_url + 'payments/pay_all/', data={}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('SELECT')]), 2)
+        self.assertEqual(response.data['errors'], [
+            'Registration is closed for presentation Closed.',
+            'No remaining capacity for presentation Full.',
+        ])
+
+
+class TwoPhaseCheckoutTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.presentation = self.create_presentation()
+        Participation.objects.create(user=self.user, presentation=self.presentation)
+
+    @staticmethod
+    def gateway_response(authority='A0000000000000000000000000000012345'):
+        return {'status': 'success', 'authority': authority, 'error': None,
+                'link': ZarrinPal().generate_link(authority)}
+
+    def test_gateway_is_called_outside_transaction(self):
+        outer_blocks = len(connection.atomic_blocks)
+
+        def create_payment(*args, **kwargs):
+            self.assertEqual(len(connection.atomic_blocks), outer_blocks)
+            return self.gateway_response()
+
+        with mock.patch.object(ZarrinPal, 'create_payment', side_effect=create_payment):
+            response = self.client.post(self.base_url + 'payments/pay_all/', data={}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        payment = Payment.objects.get(user=self.user)
+        self.assertEqual(response.data['authority'], payment.authority)
+        self.assertEqual(payment.initiation.state, 'SENT')
+
+    def test_retry_after_unreachable_gateway_reuses_the_payment(self):
+        unreachable = ZarrinPal.create_payment_error('Connection refused')
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=unreachable):
+            response = self.client.post(self.base_url + 'payments/pay_all/', data={}, format='json')
+        self.assertEqual(response.status_code, 503)
+        payment = Payment.objects.get(user=self.user)
+        self.assertEqual((payment.payment_state, payment.initiation.state), ('PENDING', 'PENDING'))
+
+        # Initiated in the background meanwhile: the retry gets that pay link, without asking the gateway again.
+        PaymentInitiation.objects.filter(payment=payment).update(
+            created_date=timezone.now() - timedelta(minutes=5), next_attempt=timezone.now()
+        )
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=self.gateway_response()):
+            call_command('process_payment_initiations', stdout=StringIO())
+        with mock.patch.object(ZarrinPal, 'create_payment') as create_payment:
+            response = self.client.post(self.base_url + 'payments/pay_all/', data={}, format='json')
+        self.assertEqual(response.status_code, 200)
+        create_payment.assert_not_called()
+        payment = Payment.objects.get(user=self.user)
+        self.assertEqual(response.data, {'payment_url': payment.pay_link, 'authority': payment.authority})
+
+        # A different cart is a different payment.
+        Coupon.objects.create(name='linux', count=1, percentage=50)
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=self.gateway_response('A1')):
+            response = self.client.post(self.base_url + 'payments/pay_all/', data={'coupon': 'linux'}, format='json')
+        self.assertEqual(response.data['authority'], 'A1')
+        self.assertEqual(Payment.objects.filter(user=self.user).count(), 2)
+
+    def test_coupon_is_redeemed_on_verify(self):
+        coupon = Coupon.objects.create(name='linux', count=1, percentage=50)
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=self.gateway_response()):
+            response = self.client.post(self.base_url + 'payments/pay_all/', data={'coupon': 'linux'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.count, 1)
+
+        # Another checkout used the last coupon while this one was on the gateway.
+        Coupon.objects.filter(pk=coupon.pk).update(count=0)
+        verified = {'status': 'success', 'ref_id': 7, 'error': None, 'card_pan': '6037'}
+        with mock.patch.object(ZarrinPal, 'verify_payment', return_value=verified):
+            response = self.client.post(self.base_url + 'payments/verify/',
+                                        data={'authority': response.data['authority']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['amount'], 50_000)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.count, 0)
+
+    def test_process_stuck_initiations(self):
+        stuck = Payment.objects.create(user=self.user, total_price=100_000)
+        PaymentInitiation.objects.create(payment=stuck)
+        old = Payment.objects.create(user=self.user, total_price=100_000)
+        PaymentInitiation.objects.create(payment=old)
+        PaymentInitiation.objects.filter(payment=stuck).update(created_date=timezone.now() - timedelta(minutes=5))
+        PaymentInitiation.objects.filter(payment=old).update(created_date=timezone.now() - timedelta(hours=1))
+
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=self.gateway_response()):
+            call_command('process_payment_initiations', stdout=StringIO())
+
+        stuck.refresh_from_db()
+        old.refresh_from_db()
+        self.assertEqual((stuck.initiation.state, stuck.payment_state), ('SENT', 'PENDING'))
+        self.assertIsNotNone(stuck.pay_link)
+        self.assertEqual((old.initiation.state, old.payment_state), ('EXPIRED', 'FAILED'))
+
+    def test_process_initiations_in_a_loop(self):
+        payment = Payment.objects.create(user=self.user, total_price=100_000)
+        PaymentInitiation.objects.create(payment=payment)
+        PaymentInitiation.objects.filter(payment=payment).update(created_date=timezone.now() - timedelta(minutes=5))
+
+        command = 'shop.management.commands.process_payment_initiations'
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=self.gateway_response()), \
+                mock.patch(f'{command}.time.sleep', side_effect=[None, KeyboardInterrupt()]), \
+                mock.patch(f'{command}.close_old_connections'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('process_payment_initiations', '--loop', stdout=StringIO())
+        payment.refresh_from_db()
+        self.assertEqual(payment.initiation.state, 'SENT')
+
+    def test_unreachable_gateway_is_retried_with_backoff(self):
+        payment = Payment.objects.create(user=self.user, total_price=100_000)
+        PaymentInitiation.objects.create(payment=payment)
+        PaymentInitiation.objects.filter(payment=payment).update(created_date=timezone.now() - timedelta(minutes=5))
+        unreachable = ZarrinPal.create_payment_error('Connection refused')
+
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=unreachable) as create_payment:
+            call_command('process_payment_initiations', stdout=StringIO())
+            call_command('process_payment_initiations', stdout=StringIO())
+        self.assertEqual(create_payment.call_count, 1)
+        payment.refresh_from_db()
+        self.assertEqual((payment.initiation.state, payment.initiation.attempts), ('PENDING', 1))
+        self.assertEqual(payment.payment_state, 'PENDING')
+
+        PaymentInitiation.objects.filter(payment=payment).update(next_attempt=timezone.now())
+        with mock.patch.object(ZarrinPal, 'create_payment', return_value=unreachable):
+            call_command('process_payment_initiations', '--max-attempts=2', stdout=StringIO())
+            call_command('process_payment_initiations', '--max-attempts=2', stdout=StringIO())
+        payment.refresh_from_db()
+        self.assertEqual((payment.initiation.state, payment.payment_state), ('EXPIRED', 'FAILED'))
+
+
+class CouponGenerationTestCase(ShopTestCase):
+    def test_generate_coupons(self):
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('generate_coupons', '2500', '--prefix', 'SPONSOR-', '--percentage', '20', stdout=out,
+                         stderr=StringIO())
+        self.assertLess(len(queries), 30)
+
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(len({row['code'] for row in rows}), 2500)
+        self.assertTrue(all(row['code'].startswith('SPONSOR-') and row['uses'] == '1' for row in rows))
+        self.assertEqual(Coupon.objects.filter(name__startswith='SPONSOR-', percentage=20).count(), 2500)
+
+    def test_code_space_is_checked(self):
+        for length in (0, 1):
+            with self.assertRaises(ValueError):
+                Coupon.objects.generate(40, prefix='X', length=length)
+        Coupon.objects.generate(4, prefix='X', length=1)
+        with self.assertRaises(ValueError):  # 4 of the 32 one character codes are taken.
+            Coupon.objects.generate(5, prefix='X', length=1)
+
+        with mock.patch('shop.models.secrets.choice', return_value='A'), self.assertRaises(ValueError):
+            Coupon.objects.generate(2, prefix='Y', length=4)  # Every batch draws the taken YAAAA.
+
+    def test_admin_generate_action(self):
+        admin_user = User.objects.create_superuser(phone_number='09120000001', password='te123456', first_name='admin',
+                                                   last_name='admin', email='admin@gmail.com')
+        self.client.force_login(admin_user)
+
+        response = self.client.post('/admin/shop/coupon/', {
+            'action': 'generate_coupons', 'count': '50', 'prefix': 'SPONSOR-', 'percentage': '30', 'uses': '1',
+        })
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(response.content.decode())))
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(Coupon.objects.filter(name__startswith='SPONSOR-', percentage=30, count=1).count(), 50)
+
+        response = self.client.post('/admin/shop/coupon/', {
+            'action': 'generate_coupons', '_selected_action': [rows[0]['code']], 'count': '5', 'prefix': 'VIP-',
+            'percentage': '100', 'uses': '3',
+        })
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(Coupon.objects.filter(name__startswith='VIP-', percentage=100, count=3).count(), 5)
+
+        response = self.client.post('/admin/shop/coupon/', {'action': 'generate_coupons', 'count': '5'}, follow=True)
+        self.assertContains(response, 'Enter the number of coupons to generate and their percentage.')
+
+
+class PresentationAdminTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create_superuser(phone_number='09120000001', password='te123456', first_name='admin',
+                                                   last_name='admin', email='admin@gmail.com')
+        self.client.force_login(admin_user)
+        self.presentations = [self.create_presentation(), self.create_presentation(title='Kernel 101')]
+        for i in range(20):
+            user = User.objects.create_user(phone_number=f'091200001{i:02d}', password='te123456', first_name='test',
+                                            last_name='test', email=f'test{i}@gmail.com', is_active=True)
+            Participation.objects.create(user=user, presentation=self.presentations[i % 2],
+                                         payment_state='COMPLETED' if i < 16 else 'PENDING')
+
+    def test_send_registration_sms(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/admin/shop/presentation/', {
+                'action': 'send_registration_sms', '_selected_action': [self.presentations[0].id],
+            }, follow=True)
+        self.assertLess(len(queries), 15)
+        self.assertContains(response, 'Queued 8 reminder SMS for 1 presentation(s)')
+        self.assertEqual(
+            set(SMSMessage.objects.values_list('mobile', flat=True)),
+            set(Participation.objects.filter(presentation=self.presentations[0], payment_state='COMPLETED')
+                .values_list('user__phone_number', flat=True))
+        )
+
+    def test_export_registrations(self):
+        response = self.client.post('/admin/shop/presentation/', {
+            'action': 'export_registrations', '_selected_action': [self.presentations[1].id],
+        })
+        self.assertTrue(response.streaming)
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 8)
+        self.assertEqual({row['presentation'] for row in rows}, {'Kernel 101'})
+
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(registration_rows(Presentation.objects.filter(id=self.presentations[1].id), chunk_size=3))
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(len(queries), 4)  # The presentation, and three chunks.
+
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(registration_rows(Presentation.objects.filter(id=self.presentations[1].id), chunk_size=4))
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(len(queries), 4)  # Two full chunks, and an empty one to find the end.
+
+        response = self.client.post('/admin/shop/presentation/', {
+            'action': 'export_registrations_json_lines', '_selected_action': [p.id for p in self.presentations],
+        })
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 16)
+        self.assertEqual(rows[0].keys(), {'presentation', 'phone_number', 'first_name', 'last_name', 'email'})
+
+
+class AdminChangelistTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create_superuser(phone_number='09120000001', password='te123456', first_name='admin',
+                                                   last_name='admin', email='admin@gmail.com')
+        self.client.force_login(admin_user)
+        self.users = 0
+
+    def add_rows(self, count):
+        coupon = Coupon.objects.create(name=f'COUPON{self.users}', count=10, percentage=10)
+        for _ in range(count):
+            user = User.objects.create_user(phone_number=f'09121{self.users:06d}', password='te123456',
+                                            first_name='test', last_name='test', email=f'test{self.users}@gmail.com')
+            self.users += 1
+            presentation = self.create_presentation(title=f'Presentation {self.users}')
+            presentation.presenters.add(Presenter.objects.create(first_name=f'test{self.users}', last_name='test',
+                                                                  description=''))
+            Participation.objects.create(user=user, presentation=presentation, payment_state='COMPLETED')
+            WaitlistEntry.objects.create(user=user, presentation=presentation)
+            Payment.objects.create(user=user, total_price=100_000, payment_state='COMPLETED', coupon=coupon)
+            user.accessories.add(Accessory.objects.create(name=f'Shirt {self.users}', description=''))
+
+    def changelist_queries(self, url):
+        self.client.get(url)  # Warms up the session and content type caches.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        urls = ['/admin/shop/presentation/', '/admin/shop/participation/', '/admin/shop/payment/',
+                '/admin/shop/coupon/', '/admin/shop/waitlistentry/', '/admin/accounts/user/',
+                '/admin/accounts/accessory/']
+        self.add_rows(2)
+        before = {url: self.changelist_queries(url) for url in urls}
+        self.add_rows(10)
+        self.assertEqual({url: self.changelist_queries(url) for url in urls}, before)
+
+    def test_change_forms_do_not_list_related_tables(self):
+        self.add_rows(2)
+        payment, participation = Payment.objects.first(), Participation.objects.first()
+        urls = [f'/admin/shop/payment/{payment.id}/change/', f'/admin/shop/participation/{participation.id}/change/',
+                f'/admin/accounts/user/{payment.user_id}/change/']
+        before = {url: self.changelist_queries(url) for url in urls}
+        self.add_rows(10)
+        self.assertEqual({url: self.changelist_queries(url) for url in urls}, before)
+
+        response = self.client.get('/admin/autocomplete/', {
+            'app_label': 'shop', 'model_name': 'payment', 'field_name': 'participations', 'term': '0912100001',
+        })
+        self.assertEqual(len(response.json()['results']), 2)
+
+
+class EstimatedCountPaginatorTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(8):
+            Payment.objects.create(user=self.user, total_price=100_000,
+                                   payment_state='COMPLETED' if i < 3 else 'FAILED')
+
+    def count(self, queryset):
+        return EstimatedCountPaginator(queryset, 20).count
+
+    def test_exact_count_off_mysql(self):
+        self.assertEqual(self.count(Payment.objects.order_by('id')), 8)
+
+    @mock.patch.object(EstimatedCountPaginator, 'threshold', 5)
+    @mock.patch('shop.pagination.explain_rows_estimate', return_value=40)
+    @mock.patch('shop.pagination.table_rows_estimate', return_value=2_000_000)
+    def test_estimates_on_mysql(self, table_rows_estimate, explain_rows_estimate):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            with self.assertNumQueries(0):
+                self.assertEqual(self.count(Payment.objects.order_by('id')), 2_000_000)
+            self.assertEqual(self.count(Payment.objects.filter(payment_state='COMPLETED')), 3)
+            self.assertEqual(self.count(Payment.objects.filter(payment_state='FAILED')), 40)
+
+            table_rows_estimate.return_value = 4  # A small table is counted exactly.
+            self.assertEqual(self.count(Payment.objects.order_by('id')), 8)
+
+
+class FakeGatewayTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gateway = FakeGateway(hang=0.5)
+        self.gateway.start()
+        self.addCleanup(self.gateway.stop)
+
+        for name, url in [('PAY_URL', REQUEST_PATH), ('VERIFY_URL', VERIFY_PATH),
+                          ('START_PAY_URL', START_PAY_PATH + '{authority}')]:
+            patcher = mock.patch.object(ZarrinPal, name, self.gateway.url + url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name, value in [('TIMEOUT', (1, 0.2)), ('RETRY_BACKOFF', 0)]:
+            patcher = mock.patch.object(ZarrinPal, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class ZarrinPalClientTestCase(FakeGatewayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.circuit_breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        self.zarrinpal = ZarrinPal(session=build_session(), circuit_breaker=self.circuit_breaker)
+
+    def test_create_payment(self):
+        response = self.zarrinpal.create_payment(amount=1000, mobile=self.user.phone_number, email=self.user.email)
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['link'], f'{self.gateway.url}/pg/StartPay/{response["authority"]}')
+        self.assertEqual(self.gateway.transactions[response['authority']]['amount'], 10_000)
+
+    def test_rejected_request_message(self):
+        self.gateway.fail_next(ZarrinPal.STATUS_NOT_VALID)
+        response = self.zarrinpal.create_payment(amount=1000, mobile=self.user.phone_number, email=self.user.email)
+        self.assertEqual((response['status'], response['error']),
+                         ('failed', 'The input params invalid, validation error.'))
+
+    def test_start_pay_and_verify(self):
+        self.gateway.auto_pay = False
+        response = self.zarrinpal.create_payment(amount=1000, mobile=self.user.phone_number, email=self.user.email)
+        authority = response['authority']
+        self.assertEqual(self.zarrinpal.verify_payment(authority=authority, amount=1000)['status'], 'failed')
+
+        redirect = build_session().get(response['link'], allow_redirects=False)
+        self.assertEqual(redirect.headers['Location'],
+                         f'{ZarrinPal.CALLBACK_URL}?Authority={authority}&Status=OK')
+
+        self.assertEqual(self.zarrinpal.verify_payment(authority=authority, amount=999)['status'], 'failed')
+        response = self.zarrinpal.verify_payment(authority=authority, amount=1000)
+        self.assertEqual((response['status'], response['ref_id']), ('success', 1))
+        response = self.zarrinpal.verify_payment(authority=authority, amount=1000)
+        self.assertEqual((response['status'], response['ref_id']), ('success', 1))
+
+    def test_verify_retries_transport_failures(self):
+        authority = self.gateway.issue(10_000)
+        self.gateway.fail_next(SERVER_ERROR, TIMEOUT)
+        response = self.zarrinpal.verify_payment(authority=authority, amount=1000)
+        self.assertEqual((response['status'], response['ref_id']), ('success', 1))
+        self.assertEqual(len(self.gateway.requests), 3)
+
+    def test_create_payment_is_not_retried(self):
+        self.gateway.fail_next(TIMEOUT)
+        response = self.zarrinpal.create_payment(amount=1000, mobile=self.user.phone_number, email=self.user.email)
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    def test_circuit_breaker_fails_fast(self):
+        authority = self.gateway.issue(10_000)
+        self.gateway.fail_next(*[SERVER_ERROR] * 3)
+        response = self.zarrinpal.verify_payment(authority=authority, amount=1000)
+        self.assertEqual(response['status'], 'unexpected')
+
+        response = self.zarrinpal.create_payment(amount=1000, mobile=self.user.phone_number, email=self.user.email)
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(len(self.gateway.requests), 3)
+
+        self.circuit_breaker.opened_at -= 60
+        response = self.zarrinpal.verify_payment(authority=authority, amount=1000)
+        self.assertEqual(response['status'], 'success')
+        self.assertIsNone(self.circuit_breaker.opened_at)
+
+
+class ReconcilePendingPaymentsTestCase(FakeGatewayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.presentation = self.create_presentation()
+        self.coupon = Coupon.objects.create(name='linux', count=5, percentage=10)
+
+    def create_payment(self, age=timedelta(hours=1), paid=True, fault=None, **kwargs):
+        number = Payment.objects.count()
+        user = User.objects.create_user(phone_number=f'0912{number:07d}', password='te123456', first_name='test',
+                                        last_name='test', email=f'test{number}@gmail.com', is_active=True)
+        participation = Participation.objects.create(user=user, presentation=self.presentation)
+        authority = self.gateway.issue(1_000_000, paid=paid, fault=fault)
+        payment = Payment.objects.create(user=user, total_price=100_000, authority=authority, **kwargs)
+        Payment.objects.filter(pk=payment.pk).update(created_date=timezone.now() - age)
+        payment.participations.add(participation)
+        return payment
+
+    def test_reconcile(self):
+        completed = [self.create_payment(coupon=self.coupon) for _ in range(3)]
+        failed = self.create_payment(paid=False)
+        unreachable = self.create_payment(fault=SERVER_ERROR)
+        recent = self.create_payment(age=timedelta(minutes=1))
+        Presentation.objects.filter(pk=self.presentation.pk).update(reserved_count=6)
+
+        out = StringIO()
+        call_command('reconcile_pending_payments', '--chunk-size', '2', '--workers', '3', stdout=out)
+        self.assertIn('Completed 3 and failed 1 of 5 stale payment(s).', out.getvalue())
+
+        states = dict(Payment.objects.values_list('authority', 'payment_state'))
+        self.assertEqual([states[payment.authority] for payment in completed], ['COMPLETED'] * 3)
+        self.assertEqual(
+            [states[payment.authority] for payment in (failed, unreachable, recent)], ['FAILED', 'PENDING', 'PENDING']
+        )
+        self.assertEqual(Participation.objects.filter(payment_state='COMPLETED').count(), 3)
+        self.presentation.refresh_from_db()
+        self.assertEqual((self.presentation.reserved_count, self.presentation.sold_count), (3, 3))
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.count, 2)
+
+
+class AsyncPaymentTestCase(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.async_client = AsyncClient()
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        self.presentation = self.create_presentation()
+        Participation.objects.create(user=self.user, presentation=self.presentation)
+        Presentation.objects.filter(pk=self.presentation.pk).update(reserved_count=1)
+
+    async def test_pay_all_and_verify(self):
+        created = {'status': 'success', 'authority': 'A123', 'error': None, 'link': 'https://gateway/A123'}
+        verified = {'status': 'success', 'ref_id': 7, 'error': None, 'card_pan': '6037'}
+
+        with mock.patch.object(AsyncZarrinPal, 'create_payment', return_value=created):
+            response = await self.async_client.post(self.base_url + 'async/payments/pay_all/', {},
+                                                    content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['authority'], 'A123')
+
+        with mock.patch.object(AsyncZarrinPal, 'verify_payment', return_value=verified):
+            response = await self.async_client.post(self.base_url + 'async/payments/verify/', {'authority': 'A123'},
+                                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ref_id'], 7)
+
+        participation = await Participation.objects.aget(user=self.user)
+        self.assertEqual(participation.payment_state, 'COMPLETED')
+
+    async def test_requires_authentication(self):
+        response = await self.async_client.post(self.base_url + 'async/payments/pay_all/', {},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_malformed_body_is_rejected(self):
+        response = await self.async_client.post(self.base_url + 'async/payments/pay_all/', '{',
+                                                content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CACHES=WAITING_ROOM_CACHES, WAITING_ROOM_RATE=1, WAITING_ROOM_BURST=0)
+    async def test_shares_the_waiting_room(self):
+        response = await self.async_client.post(self.base_url + 'async/payments/pay_all/', {},
+                                                content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['position'], 1)
+        self.assertIn('Retry-After', response.headers)
+
+    async def test_gateway_client_is_closed(self):
+        async with AsyncZarrinPal() as zarrinpal:
+            client = zarrinpal.client
+        self.assertTrue(client.is_closed)
+
+    async def test_gateway_client_is_shared_for_the_asgi_lifespan(self):
+        received, sent = asyncio.Queue(), []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        lifespan = asyncio.create_task(application({'type': 'lifespan'}, received.get, send))
+        await received.put({'type': 'lifespan.startup'})
+        while not sent:
+            await asyncio.sleep(0)
+        async with AsyncZarrinPal() as first, AsyncZarrinPal() as second:
+            self.assertIs(first.client, second.client)
+        self.assertFalse(first.client.is_closed)
+
+        await received.put({'type': 'lifespan.shutdown'})
+        await lifespan
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(first.client.is_closed)
+
+    async def test_competition_signup(self):
+        created = {'status': 'failed', 'authority': None, 'error': 'Gateway says no.', 'link': None}
+        with mock.patch.object(AsyncZarrinPal, 'create_payment', return_value=created):
+            response = await self.async_client.post(self.base_url + 'async/users/competition_signup/',
+                                                    headers=self.headers)
+        self.assertEqual(response.status_code, 500)
+        payment = await Payment.objects.aget(user=self.user, is_competition_payment=True)
+        self.assertEqual(payment.payment_state, 'FAILED')
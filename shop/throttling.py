@@ -0,0 +1,123 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Error, Tags, register
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+from accounts.throttling import THROTTLE_CACHE
+
+# Seconds of inactivity after which the state of a waiting room is forgotten.
+ROOM_TIMEOUT = 60 * 60
+
+WAITING_ROOM_CACHE = 'waiting_room'
+# Backends whose incr is atomic and shared by every worker. The database cache's incr is a read and a write,
+# and it would move the contention of a rush from the presentation row to the cache table.
+ATOMIC_CACHE_BACKENDS = [
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+]
+
+
+@register(Tags.caches)
+def check_atomic_caches(app_configs, **kwargs):
+    """The waiting room and the auth throttles count in caches that have to be atomic and shared."""
+    users = [
+        (WAITING_ROOM_CACHE, 'The waiting room', bool(settings.WAITING_ROOM_RATE),
+         'Set WAITING_ROOM_CACHE_URL, or turn the waiting room off with WAITING_ROOM_RATE=0.', 'shop.E001'),
+        (THROTTLE_CACHE, 'The auth throttles', any(settings.AUTH_THROTTLE_RATES.values()),
+         'Set THROTTLE_CACHE_URL, or turn the throttles off with empty AUTH_THROTTLE_RATES.', 'shop.E002'),
+    ]
+    errors = []
+    for alias, user, enabled, hint, error_id in users:
+        backend = settings.CACHES.get(alias, {}).get('BACKEND')
+        if enabled and backend not in ATOMIC_CACHE_BACKENDS:
+            errors.append(Error(f'{user} needs a Redis or memcached "{alias}" cache, not {backend}.', hint=hint, id=error_id))
+    return errors
+
+
+class WaitingRoomFull(APIException):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    default_code = 'waiting_room'
+
+    def __init__(self, position, wait):
+        super().__init__('Too many people are registering right now, you are in the waiting room.')
+        # Set after the fact, so the numbers aren't turned into strings. DRF's exception handler turns `wait`
+        # into the Retry-After header.
+        self.detail = {'detail': self.detail, 'position': position, 'retry_after': wait}
+        self.wait = wait
+
+
+class WaitingRoom:
+    """
+    A FIFO queue of tickets in the cache. Every client gets a ticket on its first request and keeps it on
+    retries. Tickets are admitted in order, `rate` per second, after a `burst` admitted right away. An idle
+    room never banks more than `burst` admissions, so the next rush is queued again. An admitted client
+    stays admitted for `admission_seconds`.
+
+    The tickets are handed out with cache.incr, so the room needs the atomic, shared WAITING_ROOM_CACHE
+    (Redis or memcached), see check_atomic_caches.
+    """
+
+    def __init__(self, name, rate=None, burst=None, admission_seconds=None):
+        self.name = name
+        self.rate = rate or settings.WAITING_ROOM_RATE
+        self.burst = burst if burst is not None else settings.WAITING_ROOM_BURST
+        self.admission_seconds = admission_seconds or settings.WAITING_ROOM_ADMISSION_SECONDS
+        self.cache = caches[WAITING_ROOM_CACHE]
+
+    def key(self, *parts):
+        return ':'.join(('waiting_room', self.name) + parts)
+
+    def admit(self, client):
+        """Return if `client` may go ahead, or raise WaitingRoomFull with its position in the queue."""
+        admission_key, ticket_key = self.key('admitted', str(client)), self.key('ticket', str(client))
+        last_key, head_key = self.key('last'), self.key('head')
+        # One round trip for a client that is admitted, or waiting and retrying.
+        values = self.cache.get_many([admission_key, ticket_key, last_key, head_key])
+        if values.get(admission_key):
+            return
+
+        ticket, last = values.get(ticket_key), values.get(last_key, 0)
+        if ticket is None:
+            self.cache.add(last_key, 0, ROOM_TIMEOUT)
+            ticket = last = self.cache.incr(last_key)
+            # Kept alive for as long as tickets are handed out, so the numbering can't restart mid rush.
+            self.cache.touch(last_key, ROOM_TIMEOUT)
+            self.cache.set(ticket_key, ticket, ROOM_TIMEOUT)
+
+        # The head of the queue moves `rate` tickets per second, without getting more than `burst` ahead. It
+        # is only written when it moved by a whole ticket, so waiting clients mostly just read it.
+        now = time.time()
+        head, moved = values.get(head_key, (self.burst, now))
+        advanced = math.floor((now - moved) * self.rate)
+        if advanced >= 1 or head_key not in values:
+            head = min(head + advanced, last + self.burst)
+            self.cache.set(head_key, (head, moved + advanced / self.rate), ROOM_TIMEOUT)
+
+        if ticket <= head:
+            self.cache.set(admission_key, True, self.admission_seconds)
+            self.cache.delete(ticket_key)
+            return
+
+        position = math.ceil(ticket - head)
+        raise WaitingRoomFull(position, math.ceil(position / self.rate))
+
+
+class WaitingRoomThrottle(BaseThrottle):
+    """
+    Admission control in front of registration endpoints, with a waiting room per action and object, so a
+    rush on a popular presentation is let through at WAITING_ROOM_RATE instead of piling up on its row.
+    """
+
+    def allow_request(self, request, view):
+        if not settings.WAITING_ROOM_RATE:
+            return True
+
+        name = view.action if 'pk' not in view.kwargs else f'{view.action}:{view.kwargs["pk"]}'
+        WaitingRoom(name).admit(request.user.pk)
+        return True
@@ -1,5 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import PresentationViewSet, PaymentViewSet, CouponViewSet, PresenterViewSet
 
 router = DefaultRouter()
@@ -9,5 +10,8 @@ router.register(r'coupon', CouponViewSet, basename='coupon')
 router.register(r'presenter', PresenterViewSet, basename='presenter')
 
 urlpatterns = [
+    path('async/payments/pay_all/', async_views.pay_all, name='async-pay-all'),
+    path('async/payments/verify/', async_views.verify, name='async-verify'),
+    path('async/users/competition_signup/', async_views.competition_signup, name='async-competition-signup'),
     path('', include(router.urls)),
 ]
@@ -1,6 +1,8 @@
-from django.db import transaction
+from django.db import transaction, IntegrityError
+from django.db.models import Prefetch
 from django.utils import timezone
-from drf_spectacular.utils import extend_schema
+from django.utils.decorators import method_decorator
+from drf_spectacular.utils import extend_schema, OpenApiParameter
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status, viewsets, mixins
 from rest_framework.decorators import action
@@ -8,66 +10,92 @@ from rest_framework.generics import get_object_or_404, RetrieveAPIView
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 
-from accounts.models import Accessory
-from .models import Presentation, Participation, Payment, Coupon, Presenter
-from .payments import ZarrinPal
+from .catalog import catalog_condition
+from .checkout import reserve_checkout, initiate_payment, initiation_response, verify_payment, verification_response
+from .models import Presentation, Participation, Payment, Coupon, Presenter, WaitlistEntry, PAYMENT_STATES, \
+    hold_expiry
+from .pagination import PaymentCursorPagination
 from .serializers import PresentationSerializer, ParticipationSerializer, PayAllSerializer, PaymentVerifySerializer, \
-    CartSerializer, PaymentListSerializer, CouponSerializer, PresenterSerializer
+    CartSerializer, PaymentListSerializer, CouponSerializer, PresenterSerializer, CartDetailSerializer
+from .throttling import WaitingRoomThrottle
 
 
 class PresentationViewSet(RetrieveAPIView, viewsets.ViewSet):
-    queryset = Presentation.objects.all()
+    queryset = Presentation.objects.prefetch_related('presenters', 'tags')
     serializer_class = PresentationSerializer
 
     @extend_schema(responses={200: PresentationSerializer(many=True)})
     @action(detail=False, methods=['get'], permission_classes=[AllowAny], )
+    @method_decorator(catalog_condition)
     def all(self, request):
-        presentations = Presentation.objects.all()
+        presentations = self.get_queryset()
         serializer = PresentationSerializer(presentations, many=True)
         return Response(serializer.data)
 
-    @extend_schema(responses={200: CartSerializer(many=True)})
+    @extend_schema(
+        parameters=[OpenApiParameter('full', bool, description='Embed the full presentation details.')],
+        responses={200: CartSerializer(many=True)},
+    )
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def cart(self, request):
-        participations = Participation.objects.filter(user=request.user)
-        serializer = CartSerializer(participations, many=True)
+        participations = Participation.objects.filter(user=request.user).select_related('presentation')
+
+        if request.query_params.get('full') in ('1', 'true'):
+            participations = participations.prefetch_related('presentation__presenters', 'presentation__tags')
+            serializer = CartDetailSerializer(participations, many=True)
+        else:
+            participations = participations.only(
+                'payment_state', 'held_until', 'presentation__en_title', 'presentation__fa_title',
+                'presentation__start', 'presentation__end', 'presentation__cost', 'presentation__service_type',
+            )
+            serializer = CartSerializer(participations, many=True)
         return Response(serializer.data)
 
     @extend_schema(responses={201: "detail"})
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated],
+            throttle_classes=[WaitingRoomThrottle])
     @transaction.atomic
     def add_participation(self, request, pk=None):
         try:
-            presentation = Presentation.objects.select_for_update().get(id=pk)
+            presentation = Presentation.objects.get(id=pk)
         except Presentation.DoesNotExist:
             return Response({'error': 'No presentation found.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        if Participation.objects.filter(user=request.user, presentation=presentation).exists():
-            return Response({'detail': 'Already participating in this presentation.'},
-                            status=status.HTTP_400_BAD_REQUEST)
-
         if not presentation.is_registration_active:
             return Response({'detail': 'Registration is closed for this presentation.'},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        if presentation.get_remained_capacity() < 1:
+        if presentation.start <= timezone.now():
             return Response(
-                {'detail': f'No remaining capacity for presentation {presentation.en_title}.'},
+                {'detail': f'Presentation {presentation.en_title} has already started.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        if presentation.start <= timezone.now():
+        # Duplicates are rejected by the unique (user, presentation) constraint, not by a lookup beforehand.
+        try:
+            with transaction.atomic():
+                Participation.objects.create(
+                    user=request.user,
+                    presentation=presentation,
+                    payment_state='PENDING',
+                    held_until=hold_expiry(),
+                )
+        except IntegrityError:
+            # A participation failed by an expired seat hold is taken up again.
+            retaken = Participation.objects.filter(
+                user=request.user, presentation=presentation, payment_state="FAILED"
+            ).update(payment_state="PENDING", held_until=hold_expiry())
+            if not retaken:
+                return Response({'detail': 'Already participating in this presentation.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        if not presentation.reserve_seat():
+            transaction.set_rollback(True)
             return Response(
-                {'detail': f'Presentation {presentation.en_title} has already started.'},
+                {'detail': f'No remaining capacity for presentation {presentation.en_title}.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        participation = Participation.objects.create(
-            user=request.user,
-            presentation=presentation,
-            payment_state='PENDING',
-        )
-
         return Response({"detail": "Participation created successfully."}, status=status.HTTP_201_CREATED)
 
     @extend_schema(responses={200: "detail"})
@@ -94,169 +122,121 @@ class PresentationViewSet(RetrieveAPIView, viewsets.ViewSet):
             )
 
         participation.delete()
+        if participation.payment_state == "PENDING":
+            Presentation.release_seats(presentation.id)
+            Presentation.promote_waitlist(presentation.id)
 
         return Response({'detail': 'Participation removed successfully.'}, status=status.HTTP_200_OK)
 
+    @extend_schema(responses={201: "detail, position"})
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def join_waitlist(self, request, pk=None):
+        try:
+            presentation = Presentation.objects.get(id=pk)
+        except Presentation.DoesNotExist:
+            return Response({'error': 'No presentation found.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        if not presentation.is_registration_active or presentation.start <= timezone.now():
+            return Response({'detail': 'Registration is closed for this presentation.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if Participation.objects.filter(user=request.user, presentation=presentation).exclude(
+            payment_state="FAILED"
+        ).exists():
+            return Response({'detail': 'Already participating in this presentation.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if presentation.get_remained_capacity() > 0:
+            return Response({'detail': 'There are free seats, add a participation instead.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Joining again, e.g. from a retry loop, keeps the original place.
+        try:
+            with transaction.atomic():
+                entry = WaitlistEntry.objects.create(user=request.user, presentation=presentation)
+            status_code = status.HTTP_201_CREATED
+        except IntegrityError:
+            entry = WaitlistEntry.objects.get(user=request.user, presentation=presentation)
+            status_code = status.HTTP_200_OK
+
+        return Response({'detail': 'You are on the waitlist.', 'position': entry.position()}, status=status_code)
+
+    @extend_schema(responses={200: "detail"})
+    @action(detail=True, methods=['delete'], permission_classes=[IsAuthenticated])
+    def leave_waitlist(self, request, pk=None):
+        deleted, _ = WaitlistEntry.objects.filter(user=request.user, presentation_id=pk).delete()
+        if not deleted:
+            return Response({'detail': 'Not on the waitlist of this presentation.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'detail': 'Left the waitlist.'}, status=status.HTTP_200_OK)
+
+
+@method_decorator(catalog_condition, name='list')
 class PresenterViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = Presenter.objects.all()
     serializer_class = PresenterSerializer
 
 class PaymentViewSet(viewsets.ViewSet):
     @extend_schema(request=PayAllSerializer, responses={200: 'payment_url, authority'})
-    @action(methods=['post'], detail=False, permission_classes=[IsAuthenticated])
-    @transaction.atomic
+    @action(methods=['post'], detail=False, permission_classes=[IsAuthenticated],
+            throttle_classes=[WaitingRoomThrottle])
     def pay_all(self, request):
-        user = request.user
         serializer = PayAllSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         coupon_code = serializer.validated_data.get('coupon', None)
         accessory_ids = serializer.validated_data.get('accessories', [])
 
-        participations = Participation.objects.select_for_update().filter(user=user, payment_state="PENDING")
-        if not participations.exists():
-            return Response({"detail": "No pending participations found."},
-                            status=status.HTTP_400_BAD_REQUEST)
-
-        for participation in participations:
-            presentation = participation.presentation
-
-            if presentation.start <= timezone.now():
-                return Response(
-                    {'detail': f'Presentation {presentation.en_title} has already started.'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            if not presentation.is_registration_active:
-                return Response({'detail': 'Registration is closed for this presentation.'},
-                                status=status.HTTP_400_BAD_REQUEST)
-
-            if presentation.get_remained_capacity() < 1:
-                return Response(
-                    {'detail': f'No remaining capacity for presentation {presentation.en_title}.'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-        total_price = sum(
-            p.presentation.cost
-            for p in participations
-        )
-        accessories = Accessory.objects.filter(id__in=accessory_ids)
-        # TODO: Check for inactive accessories and return if any isn't active
-
-        if total_price == 0:
-            for accessory in accessories.all():
-                user.accessories.add(accessory)
-            participations.update(payment_state="COMPLETED")
+        # Row locks are only held while the payment is reserved, never during the gateway round-trip.
+        payment = reserve_checkout(request.user, coupon_code, accessory_ids)
+        if payment is None:
             return Response(None, status=status.HTTP_204_NO_CONTENT)
 
-        total_price += sum(accessory.price for accessory in accessories)
-
-        coupon = None
-        if coupon_code:
-            coupon = Coupon.objects.select_for_update().filter(name=coupon_code, count__gt=0).first()
-            if not coupon:
-                return Response({"detail": "کد تخفیف نامعتبر!"},
-                                status=status.HTTP_400_BAD_REQUEST)
-            discount = (coupon.percentage / 100) * total_price
-            total_price -= discount
-
-        payment = Payment.objects.create(
-            user=user,
-            total_price=total_price,
-            coupon=coupon,
-        )
-        payment.participations.set(participations)
-        payment.accessories.set(accessories)
-
-        zarrinpal = ZarrinPal()
-        zarrinpal_response = zarrinpal.create_payment(
-            amount=total_price,
-            mobile=user.phone_number,
-            email=user.email
-        )
-
-        if zarrinpal_response['status'] == 'success':
-            authority = zarrinpal_response['authority']
-            payment.authority = authority
-            payment.pay_link = zarrinpal_response['link']
-            payment.save()
-
-            participations.update(payment_state="PENDING")
-
-            return Response({
-                "payment_url": payment.pay_link,
-                "authority": authority
-            }, status=status.HTTP_200_OK)
-        else:
-            payment.payment_state = "FAILED"
-            payment.save()
-            return Response({
-                "detail": "Payment initiation failed.",
-                "error": zarrinpal_response.get('error')
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        zarrinpal_response = initiate_payment(payment)
+        data, status_code = initiation_response(payment, zarrinpal_response)
+        return Response(data, status=status_code)
 
     @extend_schema(request=PaymentVerifySerializer, responses={200: 'detail, ref_id, card_pan, amount'})
     @action(methods=['post'], detail=False, permission_classes=[])
-    @transaction.atomic
     def verify(self, request):
         serializer = PaymentVerifySerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         authority = serializer.validated_data['authority']
 
-        payment = get_object_or_404(Payment.objects.select_for_update(), authority=authority)
+        payment = get_object_or_404(Payment, authority=authority)
 
         if payment.payment_state == "COMPLETED":
             return Response({"detail": "Payment has already been verified."},
                             status=status.HTTP_200_OK)
 
-        zarrinpal = ZarrinPal()
-        zarrinpal_response = zarrinpal.verify_payment(
-            authority=authority,
-            amount=payment.total_price
-        )
+        payment, zarrinpal_response = verify_payment(payment)
+        data, status_code = verification_response(payment, zarrinpal_response)
+        return Response(data, status=status_code)
 
-        if zarrinpal_response['status'] == 'success':
-            payment.ref_id = zarrinpal_response['ref_id']
-            payment.card_pan = zarrinpal_response['card_pan']
-            payment.payment_state = "COMPLETED"
-            payment.verified_date = timezone.now()
-            payment.save()
-
-            if payment.is_competition_payment:
-                payment.user.is_signed_up_for_competition = True
-                payment.user.save()
-            else:
-                payment.participations.update(payment_state="COMPLETED")
-                if payment.coupon:
-                    payment.coupon.count -= 1
-                    payment.coupon.save()
-
-                for accessory in payment.accessories.all():
-                    payment.user.accessories.add(accessory)
-
-            return Response({
-                "detail": "Payment verified successfully.",
-                "ref_id": payment.ref_id,
-                "card_pan": payment.card_pan,
-                "amount": payment.total_price,
-            }, status=status.HTTP_200_OK)
-        else:
-            payment.payment_state = "FAILED"
-            payment.save()
-
-            return Response({
-                "detail": "Payment verification failed.",
-                "error": zarrinpal_response.get('error')
-            }, status=status.HTTP_400_BAD_REQUEST)
-
-    @extend_schema(responses={200: PaymentListSerializer(many=True)})
+    @extend_schema(
+        parameters=[OpenApiParameter('state', str, enum=[state for state, _ in PAYMENT_STATES])],
+        responses={200: PaymentListSerializer(many=True)},
+    )
     @action(methods=['get'], detail=False, permission_classes=[IsAuthenticated])
-    @transaction.atomic
     def get_list(self, request):
-        payments = Payment.objects.filter(user=request.user)
-        serializer = PaymentListSerializer(payments, many=True)
-        return Response(serializer.data)
+        payments = Payment.objects.filter(user=request.user).prefetch_related(
+            Prefetch(
+                'participations',
+                queryset=Participation.objects.select_related('presentation').prefetch_related(
+                    'presentation__presenters', 'presentation__tags'
+                ),
+            ),
+            'accessories',
+        )
+
+        state = request.query_params.get('state')
+        if state:
+            if state not in dict(PAYMENT_STATES):
+                return Response({'detail': f'Invalid payment state {state}.'}, status=status.HTTP_400_BAD_REQUEST)
+            payments = payments.filter(payment_state=state)
+
+        paginator = PaymentCursorPagination()
+        page = paginator.paginate_queryset(payments, request, view=self)
+        serializer = PaymentListSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 class CouponViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     serializer_class = CouponSerializer